@@ -1,7 +1,12 @@
 import streamlit as st
 import os
 import json
+import hashlib
+import uuid
+import concurrent.futures
+from collections import defaultdict
 from datetime import datetime, timedelta
+from pathlib import Path
 import pandas as pd
 
 
@@ -9,16 +14,153 @@ from document_processor import DocumentProcessor
 from vector_store import VectorStore
 from chat_manager import ChatManager
 from pdf_exporter import PDFExporter
-# from theme_manager import ThemeManager
-from utils import ensure_directories, format_file_size
+from theme_manager import ThemeManager
+from utils import ensure_directories, format_file_size, get_file_category, parse_timestamp, append_jsonl_record, load_jsonl_data
 from dotenv import load_dotenv
 load_dotenv()
 
+# Shared resources (built once per process instead of on every rerun)
+@st.cache_resource
+def get_doc_processor():
+    return DocumentProcessor()
+
+@st.cache_resource
+def get_pdf_exporter():
+    return PDFExporter()
+
+@st.cache_resource
+def get_theme_manager():
+    return ThemeManager()
+
+@st.cache_resource
+def get_chat_manager(provider: str):
+    return ChatManager(provider=provider)
+
+@st.cache_resource
+def get_export_executor():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+@st.cache_resource
+def get_vector_store(provider: str, doc_id: str):
+    """Load a document's vector store once and reuse it across reruns"""
+    vector_store = VectorStore(provider=provider)
+    vector_store.load_document(doc_id)
+    return vector_store
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _process_cached(file_hash: str, filename: str, _file_bytes: bytes):
+    # Keyed by content hash; the leading underscore keeps Streamlit from hashing the bytes again
+    return get_doc_processor().process_document_bytes(_file_bytes, filename)
+
+def process_uploaded_document(uploaded_file):
+    """Process an uploaded file, reusing the cached result for identical content"""
+    with uploaded_file.getbuffer() as data:
+        file_hash = hashlib.blake2b(data, digest_size=16).hexdigest()
+        result = _process_cached(file_hash, uploaded_file.name, bytes(data))
+    
+    if result['success']:
+        # Every upload still gets its own document id
+        result['metadata']['id'] = str(uuid.uuid4())
+    return result
+
+@st.cache_data(show_spinner=False)
+def _docs_df(documents: list) -> pd.DataFrame:
+    """Build the document history table with category and upload time precomputed"""
+    df = pd.DataFrame(documents, columns=None if documents else ['filename', 'file_type', 'upload_date'])
+    file_type = df['file_type'].astype(str)
+    # Classify each distinct file type once, then map the whole column
+    df['category'] = file_type.map({t: get_file_category(t) for t in file_type.unique()})
+    # isoformat() drops the fraction when microseconds are 0, so the history mixes both forms;
+    # unparseable dates become NaT, as parse_timestamp turns them into 0
+    df['upload_dt'] = pd.to_datetime(df['upload_date'], format='ISO8601', errors='coerce')
+    return df
+
+def build_category_index(documents: list) -> dict:
+    """Map each document id to its category so options and filters share one pass"""
+    return {doc['id']: get_file_category(doc['file_type']) for doc in documents}
+
+def filter_documents(df: pd.DataFrame, selected_type: str = 'All', cutoff_date=None, search_term: str = '') -> pd.DataFrame:
+    """Filter the document history table by category, upload date and filename"""
+    mask = pd.Series(True, index=df.index)
+    if selected_type != 'All':
+        mask &= df['category'] == selected_type
+    if cutoff_date is not None:
+        mask &= df['upload_dt'] >= cutoff_date
+    if search_term:
+        mask &= df['filename'].str.contains(search_term, case=False, regex=False)
+    return df[mask]
+
+# Persistent history (append-only JSON Lines, one record per line)
+DOCUMENTS_FILE = "data/documents.jsonl"
+CHAT_HISTORY_FILE = "data/chat_history.jsonl"
+
+def _add_timestamp(record: dict, source_key: str, ts_key: str) -> dict:
+    """Parse a record's ISO date once and keep it as a Unix timestamp for filtering"""
+    record[ts_key] = parse_timestamp(record.get(source_key, ''))
+    return record
+
+def load_document_info() -> list:
+    """Load the persisted document history"""
+    return [_add_timestamp(doc, 'upload_date', '_upload_ts') for doc in load_jsonl_data(DOCUMENTS_FILE)]
+
+def load_chat_history() -> list:
+    """Load the persisted chat history"""
+    return [_add_timestamp(chat, 'timestamp', '_ts') for chat in load_jsonl_data(CHAT_HISTORY_FILE)]
+
+def save_document_info(doc_info: dict):
+    """Append document info to the persisted document history"""
+    append_jsonl_record(DOCUMENTS_FILE, doc_info)
+    _add_timestamp(doc_info, 'upload_date', '_upload_ts')
+
+def save_chat_history(chat_entry: dict):
+    """Append a chat entry to the persisted chat history"""
+    append_jsonl_record(CHAT_HISTORY_FILE, chat_entry)
+    _add_timestamp(chat_entry, 'timestamp', '_ts')
+    
+    # Keep the per-document grouping in step so the history page never rebuilds it
+    if 'chats_by_doc' in st.session_state:
+        st.session_state.chats_by_doc[chat_entry.get('document_id')].append(chat_entry)
+
+def group_chats_by_document(chat_history: list) -> defaultdict:
+    """Group chat entries by the document they were asked about"""
+    chats_by_doc = defaultdict(list)
+    for chat in chat_history:
+        chats_by_doc[chat.get('document_id')].append(chat)
+    return chats_by_doc
+
+def records_since(records: list, ts_key: str, cutoff_date: datetime) -> list:
+    """Keep records at or after cutoff_date using their precomputed timestamps"""
+    cutoff_ts = cutoff_date.timestamp()
+    return [record for record in records if record[ts_key] >= cutoff_ts]
+
+def submit_chat_export(messages: list, document_name: str) -> concurrent.futures.Future:
+    """Render a chat export to PDF in the background; the future resolves to the PDF path"""
+    # Snapshot the messages so new chat turns don't change an export in progress
+    messages_snapshot = [dict(message) for message in messages]
+    return get_export_executor().submit(get_pdf_exporter().export_chat, messages_snapshot, document_name)
+
+def pdf_download_button(pdf_path: str, file_name: str, label: str = "📥 Download PDF"):
+    """Offer a generated PDF for download. Its bytes are kept in session state, so the
+    temporary file is deleted right away and later reruns (including the one a click
+    on the button triggers) can still serve it"""
+    downloads = st.session_state.setdefault('pdf_downloads', {})
+    if pdf_path not in downloads:
+        pdf_file = Path(pdf_path)
+        downloads[pdf_path] = pdf_file.read_bytes()
+        pdf_file.unlink(missing_ok=True)
+    return st.download_button(
+        label=label,
+        data=downloads[pdf_path],
+        file_name=file_name,
+        mime='application/pdf'
+    )
+
 # Initialize session state
 if 'initialized' not in st.session_state:
     st.session_state.initialized = True
-    st.session_state.documents = []
-    st.session_state.chat_history = []
+    st.session_state.documents = load_document_info()
+    st.session_state.chat_history = load_chat_history()
+    st.session_state.chats_by_doc = group_chats_by_document(st.session_state.chat_history)
     st.session_state.current_document = None
     st.session_state.vector_store = None
     st.session_state.theme = 'light'
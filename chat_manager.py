@@ -1,23 +1,55 @@
 import streamlit as st
 import os
-from typing import Dict, List, Any, Optional
-from openai import OpenAI
+import time
+import json
+import asyncio
+import threading
+from collections import OrderedDict
+import numpy as np
+from typing import Dict, List, Any, Optional, Iterator, Tuple
+from openai import AsyncOpenAI
 try:
     import google.generativeai as genai
 except ImportError:
     genai = None
+from utils import estimate_tokens, dump_json_bytes, load_json_bytes, run_async, get_openai_client, make_async_openai_client
+
+# Tokens taken by the fixed instructions of the answer prompts (excluding context, history and question)
+_PROMPT_TEMPLATE_TOKENS = 150
+
+# Speaker labels for the chat roles included in follow-up prompts
+_HISTORY_SPEAKERS = {'user': 'User', 'assistant': 'Assistant'}
+
+class ProviderError(Exception):
+    """Raised when the LLM provider fails to generate an answer"""
+
 
 class ChatManager:
     def __init__(self, provider: str = "openai"):
         self.provider = provider
-        self.max_context_length = 8000
+        self.max_context_length = 8000  # prompt + answer tokens
+        self.max_response_tokens = 1000
+        
+        # Semantic answer cache: near-identical questions about the same document
+        # are answered from here instead of re-running retrieval and the LLM call.
+        # One manager is shared by every session, so entries for all documents are
+        # kept side by side under a single LRU limit.
+        self.cache_size = 512  # answers across all documents
+        self.cache_ttl = 3600  # seconds
+        self.cache_similarity_threshold = 0.95
+        self._cache = {}  # document id -> {embedding bytes: (query embedding, result, timestamp)}
+        self._cache_lru = OrderedDict()  # (document id, embedding bytes), least recently used first
+        self._cache_lock = threading.Lock()
+        
+        # Batch API jobs submitted by this manager: batch id -> per-question placeholders
+        self._pending_batches = {}
         
         if provider == "openai":
             # the newest OpenAI model is "gpt-5" which was released August 7, 2025.
             # do not change this unless explicitly requested by the user
             api_key = os.getenv("OPENAI_API_KEY")
             if api_key:
-                self.openai_client = OpenAI(api_key=api_key)
+                self.openai_client = get_openai_client(api_key)
                 self.model = "gpt-5"
             else:
                 self.openai_client = None
@@ -38,90 +70,101 @@ class ChatManager:
                 self.google_client = None
                 self.model = None
     
-    def get_response(self, query: str, vector_store, document_info: Dict) -> Dict[str, Any]:
-        """Generate response using RAG approach"""
+    def get_response(self, query: str, vector_store, document_info: Dict, query_embedding: Optional[np.ndarray] = None) -> Dict[str, Any]:
+        """Generate response using RAG approach (pass query_embedding from embed_query to skip re-embedding)"""
         try:
-            # Check if API client is available
-            if self.provider == "openai" and not self.openai_client:
-                return {
-                    'answer': "OpenAI API key not configured. Please set your API key in the settings.",
-                    'sources': []
-                }
-            elif self.provider == "google" and not self.google_client:
-                return {
-                    'answer': "Google Gemini API key not configured. Please set your API key in the settings.",
-                    'sources': []
-                }
+            error = self._configuration_error()
+            if error:
+                return error
             
-            # Retrieve relevant chunks
-            search_results = vector_store.search(query, k=5)
+            # Answer paraphrased repeats of earlier questions from the cache
+            if query_embedding is None:
+                query_embedding = vector_store.embed_query(query)
+            cached = self._get_cached_answer(document_info.get('id'), query_embedding)
+            if cached:
+                return cached
             
-            if not search_results:
-                return {
-                    'answer': "I couldn't find relevant information in the document to answer your question.",
-                    'sources': []
-                }
+            request = self._prepare_request(query, vector_store, document_info, query_embedding=query_embedding)
+            if 'answer' in request:
+                return request
             
-            # Prepare context and sources
-            context_chunks = []
-            sources = []
+            try:
+                answer = self._generate(request['system_prompt'], request['user_message'])
+            except ProviderError as e:
+                return {'answer': str(e), 'sources': request['sources'], 'context_used': request['context_used']}
             
-            for chunk, score in search_results:
-                context_chunks.append(chunk['text'])
-                sources.append(f"Chunk {chunk['chunk_id']}: \"{chunk['text'][:100]}...\" (Relevance: {score:.2f})")
+            result = {
+                'answer': answer,
+                'sources': request['sources'],
+                'context_used': request['context_used']
+            }
+            self._cache_answer(document_info.get('id'), query, query_embedding, result)
+            return result
             
-            context = "\n\n".join(context_chunks)
+        except Exception as e:
+            return {
+                'answer': f"I encountered an error while processing your question: {str(e)}",
+                'sources': []
+            }
+    
+    def get_follow_up_response(self, query: str, chat_history: List[Dict], vector_store, document_info: Dict) -> Dict[str, Any]:
+        """Generate response with chat history context"""
+        try:
+            request = self._prepare_request(query, vector_store, document_info, chat_history)
+            if 'answer' in request:
+                return request
             
-            # Create system prompt
-            system_prompt = f"""You are an AI assistant helping users understand a document titled "{document_info['filename']}".
-
-You will be provided with relevant excerpts from the document and a user question. Your task is to:
-1. Answer the question based ONLY on the provided context
-2. Be accurate and specific
-3. If the context doesn't contain enough information to answer the question, say so clearly
-4. Cite specific parts of the context when possible
-5. Keep your answer concise but comprehensive
-
-Document context:
-{context}
-
-Remember: Only use information from the provided context. Do not add information from your general knowledge."""
+            try:
+                answer = self._generate(request['system_prompt'], request['user_message'])
+            except ProviderError as e:
+                answer = str(e)
             
-            answer = ""
-            if self.provider == "openai":
-                # Generate response with OpenAI
-                if self.openai_client and self.model:
-                    response = self.openai_client.chat.completions.create(
-                        model=self.model,
-                        messages=[
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": f"Question: {query}"}
-                        ],
-                        max_tokens=1000,
-                        temperature=0.1
-                    )
-                    answer = response.choices[0].message.content or "No response generated."
-                else:
-                    answer = "OpenAI not properly configured."
-                
-            elif self.provider == "google":
-                # Generate response with Google Gemini
-                if self.google_client and self.model:
-                    try:
-                        prompt = f"{system_prompt}\n\nQuestion: {query}"
-                        model = self.google_client.GenerativeModel(self.model)
-                        response = model.generate_content(prompt)
-                        answer = response.text or "I couldn't generate a response."
-                    except Exception as e:
-                        answer = f"Google Gemini error: {str(e)}"
-                else:
-                    answer = "Google Gemini not properly configured."
+            return {
+                'answer': answer,
+                'sources': request['sources'],
+                'context_used': request['context_used']
+            }
             
+        except Exception as e:
             return {
+                'answer': f"I encountered an error while processing your question: {str(e)}",
+                'sources': []
+            }
+    
+    async def aget_response(self, query: str, vector_store, document_info: Dict, openai_client: Optional[AsyncOpenAI] = None) -> Dict[str, Any]:
+        """Async variant of get_response: retrieval runs in a worker thread and the LLM call is awaited"""
+        try:
+            error = self._configuration_error()
+            if error:
+                return error
+            
+            if self.provider == "openai" and openai_client is None:
+                async with make_async_openai_client(self.openai_client.api_key) as client:
+                    return await self.aget_response(query, vector_store, document_info, client)
+            
+            query_embedding = await asyncio.to_thread(vector_store.embed_query, query)
+            cached = self._get_cached_answer(document_info.get('id'), query_embedding)
+            if cached:
+                return cached
+            
+            request = await asyncio.to_thread(
+                self._prepare_request, query, vector_store, document_info, query_embedding=query_embedding
+            )
+            if 'answer' in request:
+                return request
+            
+            try:
+                answer = await self._agenerate(request['system_prompt'], request['user_message'], openai_client)
+            except ProviderError as e:
+                return {'answer': str(e), 'sources': request['sources'], 'context_used': request['context_used']}
+            
+            result = {
                 'answer': answer,
-                'sources': sources,
-                'context_used': len(context_chunks)
+                'sources': request['sources'],
+                'context_used': request['context_used']
             }
+            self._cache_answer(document_info.get('id'), query, query_embedding, result)
+            return result
             
         except Exception as e:
             return {
@@ -129,42 +172,391 @@ Remember: Only use information from the provided context. Do not add information
                 'sources': []
             }
     
-    def get_follow_up_response(self, query: str, chat_history: List[Dict], vector_store, document_info: Dict) -> Dict[str, Any]:
-        """Generate response with chat history context"""
+    async def batch_answer(self, queries: List[str], vector_store, document_info: Dict, concurrency: int = 10) -> List[Dict[str, Any]]:
+        """Answer several independent questions concurrently (at most `concurrency` in flight)"""
+        semaphore = asyncio.Semaphore(concurrency)
+        openai_client = None
+        if self.provider == "openai" and self.openai_client:
+            # One client (and connection pool) for the whole batch so TLS setup is amortized
+            openai_client = make_async_openai_client(self.openai_client.api_key)
+        
+        async def answer(query: str) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.aget_response(query, vector_store, document_info, openai_client)
+        
         try:
-            # Check if API client is available
-            if self.provider == "openai" and not self.openai_client:
-                return {
-                    'answer': "OpenAI API key not configured. Please set your API key in the settings.",
-                    'sources': []
-                }
-            elif self.provider == "google" and not self.google_client:
-                return {
-                    'answer': "Google Gemini API key not configured. Please set your API key in the settings.",
-                    'sources': []
-                }
+            return await asyncio.gather(*(answer(query) for query in queries))
+        finally:
+            if openai_client:
+                await openai_client.close()
+    
+    def answer_many(self, queries: List[str], vector_store, document_info: Dict, concurrency: int = 10) -> List[Dict[str, Any]]:
+        """Synchronous entry point for batch_answer (e.g. from a Streamlit script)"""
+        return run_async(self.batch_answer(queries, vector_store, document_info, concurrency))
+    
+    def stream_response(self, query: str, vector_store, document_info: Dict, chat_history: Optional[List[Dict]] = None) -> Dict[str, Any]:
+        """Like get_response (or get_follow_up_response when chat_history is given), but
+        'answer_stream' yields the answer as it is generated, for use with st.write_stream"""
+        try:
+            request = self._prepare_request(query, vector_store, document_info, chat_history)
+        except Exception as e:
+            request = {
+                'answer': f"I encountered an error while processing your question: {str(e)}",
+                'sources': []
+            }
+        
+        if 'answer' in request:
+            return {
+                'answer_stream': iter([request['answer']]),
+                'sources': request['sources']
+            }
+        
+        return {
+            'answer_stream': self._generate_stream(request['system_prompt'], request['user_message']),
+            'sources': request['sources'],
+            'context_used': request['context_used']
+        }
+    
+    def batch_get_responses(self, queries: List[str], vector_store, document_info: Dict) -> List[Dict[str, Any]]:
+        """Answer several independent questions about a document with a single LLM request"""
+        error = self._configuration_error()
+        if error:
+            return [dict(error) for _ in queries]
+        if len(queries) == 1:
+            # Nothing to pack; skip the batch retrieval the single answer would repeat
+            return [self.get_response(queries[0], vector_store, document_info)]
+        
+        try:
+            # Retrieve context for every question with one embeddings request and one index search
+            query_embeddings = vector_store.embed_queries(queries)
+            all_results = vector_store.search_many(queries, k=5, query_embeddings=query_embeddings)
+            
+            results = [None] * len(queries)
+            pending = []  # (position, query, context, sources)
+            for i, (query, search_results) in enumerate(zip(queries, all_results)):
+                if not search_results:
+                    results[i] = {
+                        'answer': "I couldn't find relevant information in the document to answer your question.",
+                        'sources': []
+                    }
+                    continue
+                context_chunks, sources = self._format_search_results(search_results)
+                pending.append((i, query, "\n\n".join(context_chunks), sources))
+            
+            if not pending:
+                return results
+            
+            sections = "\n\n".join(
+                f"=== Question {n} ===\nContext:\n{context}\n\nQ{n}: {query}"
+                for n, (_, query, context, _) in enumerate(pending, 1)
+            )
+            system_prompt = f"""You are an AI assistant helping users understand a document titled "{document_info['filename']}".
+
+You will be given {len(pending)} independent questions, each with its own excerpts from the document. For every question:
+1. Answer it based ONLY on the context provided with that question
+2. Be accurate and specific
+3. If the context doesn't contain enough information to answer the question, say so clearly
+4. Keep your answer concise but comprehensive
+
+Respond with a JSON object of the form {{"answers": ["answer to Q1", "answer to Q2", ...]}} containing exactly {len(pending)} answers in question order."""
+            user_message = f"Answer each question independently.\n\n{sections}"
             
-            # Retrieve relevant chunks
-            search_results = vector_store.search(query, k=5)
+            answers = None
+            if len(pending) > 1 and estimate_tokens(system_prompt + user_message) <= self.max_context_length:
+                answers = self._generate_batch(system_prompt, user_message, len(pending))
             
-            # Prepare context
-            context_chunks = []
-            sources = []
+            if answers is None:
+                # Too large for one prompt (or a malformed reply): ask one question at a time
+                for i, query, _, _ in pending:
+                    results[i] = self.get_response(query, vector_store, document_info,
+                                                   query_embedding=query_embeddings[i:i + 1])
+                return results
             
-            for chunk, score in search_results:
-                context_chunks.append(chunk['text'])
-                sources.append(f"Chunk {chunk['chunk_id']}: \"{chunk['text'][:100]}...\" (Relevance: {score:.2f})")
+            for (i, _, _, sources), answer in zip(pending, answers):
+                results[i] = {
+                    'answer': answer or "No response generated.",
+                    'sources': sources,
+                    'context_used': len(sources)
+                }
+            return results
             
-            context = "\n\n".join(context_chunks)
+        except Exception as e:
+            return [{
+                'answer': f"I encountered an error while processing your question: {str(e)}",
+                'sources': []
+            } for _ in queries]
+    
+    def _generate_batch(self, system_prompt: str, user_message: str, count: int) -> Optional[List[str]]:
+        """Request `count` answers as a JSON list; returns None if the reply can't be used"""
+        if self.provider == "openai":
+            if not (self.openai_client and self.model):
+                return None
+            response = self.openai_client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_message}
+                ],
+                max_tokens=self.max_response_tokens * count,
+                temperature=0.1,
+                response_format={
+                    "type": "json_schema",
+                    "json_schema": {
+                        "name": "batch_answers",
+                        "strict": True,
+                        "schema": {
+                            "type": "object",
+                            "properties": {"answers": {"type": "array", "items": {"type": "string"}}},
+                            "required": ["answers"],
+                            "additionalProperties": False
+                        }
+                    }
+                }
+            )
+            content = response.choices[0].message.content
+        
+        elif self.provider == "google":
+            if not (self.google_client and self.model):
+                return None
+            model = self.google_client.GenerativeModel(self.model)
+            response = model.generate_content(
+                f"{system_prompt}\n\n{user_message}",
+                generation_config={"response_mime_type": "application/json"}
+            )
+            content = response.text
+        
+        else:
+            return None
+        
+        try:
+            answers = json.loads(content or "")["answers"]
+        except (ValueError, KeyError, TypeError):
+            return None
+        if not isinstance(answers, list) or len(answers) != count:
+            return None
+        return [str(answer) for answer in answers]
+    
+    def submit_batch(self, queries: List[str], vector_store, document_info: Dict) -> str:
+        """Queue questions on the OpenAI Batch API (half price, separate rate limits, results
+        within 24h) and return the batch id to pass to wait_for_batch"""
+        if self.provider != "openai" or not (self.openai_client and self.model):
+            raise ProviderError("The Batch API requires a configured OpenAI client.")
+        
+        # Retrieval happens now; only the LLM calls are deferred
+        query_embeddings = vector_store.embed_queries(queries)
+        placeholders = []  # final answer dict, or (custom_id, sources, context_used)
+        lines = []
+        for i, query in enumerate(queries):
+            request = self._prepare_request(query, vector_store, document_info,
+                                            query_embedding=query_embeddings[i:i + 1])
+            if 'answer' in request:
+                placeholders.append(request)
+                continue
+            custom_id = f"q{i}"
+            placeholders.append((custom_id, request['sources'], request['context_used']))
+            lines.append(dump_json_bytes({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": self._chat_request_body(request['system_prompt'], request['user_message'])
+            }))
+        
+        if not lines:
+            raise ProviderError("None of the questions matched the document, so there is nothing to submit.")
+        
+        input_file = self.openai_client.files.create(
+            file=("batch_input.jsonl", b"\n".join(lines) + b"\n"),
+            purpose="batch"
+        )
+        batch = self.openai_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        self._pending_batches[batch.id] = placeholders
+        return batch.id
+    
+    def wait_for_batch(self, batch_id: str, poll_interval: float = 5.0, max_poll_interval: float = 300.0,
+                       timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Poll a Batch API job until it finishes and return one answer dict per submitted question"""
+        if not self.openai_client:
+            raise ProviderError("OpenAI API key not configured.")
+        
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            batch = self.openai_client.batches.retrieve(batch_id)
+            if batch.status in ("completed", "failed", "expired", "cancelled"):
+                break
+            if deadline is not None and time.monotonic() + poll_interval > deadline:
+                raise TimeoutError(f"Batch {batch_id} still {batch.status} after {timeout:.0f}s")
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, max_poll_interval)
+        
+        # Failed or expired batches can still hold partial output
+        answers = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in self.openai_client.files.content(file_id).content.splitlines():
+                if not line.strip():
+                    continue
+                record = load_json_bytes(line)
+                response = record.get('response') or {}
+                if response.get('status_code') == 200:
+                    answers[record['custom_id']] = response['body']['choices'][0]['message']['content'] or "No response generated."
+                else:
+                    error = record.get('error') or response.get('body', {}).get('error') or {}
+                    answers[record['custom_id']] = f"OpenAI batch error: {error.get('message', batch.status)}"
+        
+        # Placeholders are lost if the process restarted since submit_batch; fall back to bare answers
+        placeholders = self._pending_batches.pop(batch_id, None)
+        if placeholders is None:
+            placeholders = [(custom_id, [], 0) for custom_id in sorted(answers, key=lambda c: int(c[1:]))]
+        
+        results = []
+        for placeholder in placeholders:
+            if isinstance(placeholder, dict):
+                results.append(placeholder)
+                continue
+            custom_id, sources, context_used = placeholder
+            results.append({
+                'answer': answers.get(custom_id, f"OpenAI batch {batch.status} without an answer for this question."),
+                'sources': sources,
+                'context_used': context_used
+            })
+        return results
+    
+    def _format_search_results(self, search_results: List[Tuple[Dict, float]]) -> Tuple[List[str], List[str]]:
+        """Split search results into context texts and human-readable source lines"""
+        context_chunks = []
+        sources = []
+        
+        for chunk, score in search_results:
+            context_chunks.append(chunk['text'])
+            sources.append(f"Chunk {chunk['chunk_id']}: \"{chunk['text'][:100]}...\" (Relevance: {score:.2f})")
+        
+        return context_chunks, sources
+    
+    def _fit_context_budget(self, search_results: List[Tuple[Dict, float]], budget: int) -> List[Tuple[Dict, float]]:
+        """Keep results in rank order while their combined tokens fit the budget (the top result always stays)"""
+        selected = []
+        used = 0
+        for chunk, score in search_results:
+            tokens = chunk.get('token_count') or estimate_tokens(chunk['text'])
+            if selected and used + tokens > budget:
+                continue
+            selected.append((chunk, score))
+            used += tokens
+        return selected
+    
+    def _configuration_error(self) -> Optional[Dict[str, Any]]:
+        """Return an answer explaining the missing API key, or None if the client is ready"""
+        if self.provider == "openai" and not self.openai_client:
+            return {
+                'answer': "OpenAI API key not configured. Please set your API key in the settings.",
+                'sources': []
+            }
+        elif self.provider == "google" and not self.google_client:
+            return {
+                'answer': "Google Gemini API key not configured. Please set your API key in the settings.",
+                'sources': []
+            }
+        return None
+    
+    def _get_cached_answer(self, document_id: Optional[str], query_embedding: np.ndarray) -> Optional[Dict[str, Any]]:
+        """Return a cached answer for a near-identical earlier question about the same document"""
+        with self._cache_lock:
+            entries = self._cache.get(document_id)
+            if not entries:
+                return None
+            
+            now = time.time()
+            for key in [key for key, (_, _, stored_at) in entries.items() if now - stored_at > self.cache_ttl]:
+                self._forget_cached_answer(document_id, key)
+            if not entries:
+                return None
             
-            # Prepare chat history
-            history_text = ""
-            for msg in chat_history[-5:]:  # Last 5 messages for context
-                if msg['role'] == 'user':
-                    history_text += f"User: {msg['content']}\n"
-                elif msg['role'] == 'assistant':
-                    history_text += f"Assistant: {msg['content']}\n"
+            # Embeddings are L2-normalized, so one matrix product gives every cosine similarity
+            keys = list(entries)
+            cached_embeddings = np.vstack([entries[key][0] for key in keys])
+            scores = cached_embeddings @ query_embedding.ravel()
+            best = int(np.argmax(scores))
+            if scores[best] < self.cache_similarity_threshold:
+                return None
             
+            self._cache_lru.move_to_end((document_id, keys[best]))
+            return dict(entries[keys[best]][1])
+    
+    def _cache_answer(self, document_id: Optional[str], query: str, query_embedding: np.ndarray, result: Dict[str, Any]):
+        """Remember an answer for the semantic cache, keyed by document and query embedding"""
+        embedding = query_embedding.ravel()
+        key = embedding.tobytes()
+        with self._cache_lock:
+            self._cache.setdefault(document_id, {})[key] = (embedding, dict(result), time.time())
+            self._cache_lru[(document_id, key)] = None
+            self._cache_lru.move_to_end((document_id, key))
+            while len(self._cache_lru) > self.cache_size:
+                self._forget_cached_answer(*next(iter(self._cache_lru)))
+    
+    def _forget_cached_answer(self, document_id: Optional[str], key: bytes):
+        """Drop one semantic cache entry (the caller holds _cache_lock)"""
+        del self._cache_lru[(document_id, key)]
+        entries = self._cache[document_id]
+        del entries[key]
+        if not entries:
+            del self._cache[document_id]
+    
+    def _prepare_request(self, query: str, vector_store, document_info: Dict, chat_history: Optional[List[Dict]] = None, query_embedding: Optional[np.ndarray] = None) -> Dict[str, Any]:
+        """Retrieve context and build the prompt; returns a final answer dict if there is nothing to ask"""
+        # Check if API client is available
+        error = self._configuration_error()
+        if error:
+            return error
+        
+        # Retrieve relevant chunks, diversified so near-duplicates don't crowd out other passages
+        search_results = vector_store.mmr_search(query, k=5, query_embedding=query_embedding)
+        
+        if chat_history is None and not search_results:
+            return {
+                'answer': "I couldn't find relevant information in the document to answer your question.",
+                'sources': []
+            }
+        
+        history_text = ""
+        if chat_history is not None:
+            # Prepare chat history from the last 5 messages, joined in one pass
+            history_text = "".join(
+                f"{_HISTORY_SPEAKERS[role]}: {msg['content']}\n"
+                for msg in chat_history[-5:]
+                if (role := msg['role']) in _HISTORY_SPEAKERS
+            )
+        
+        # Only send as much context as fits beside the prompt, history, question and answer
+        context_budget = (self.max_context_length - self.max_response_tokens - _PROMPT_TEMPLATE_TOKENS
+                          - estimate_tokens(f"{document_info['filename']}\n{history_text}\n{query}"))
+        search_results = self._fit_context_budget(search_results, context_budget)
+        
+        # Prepare context and sources
+        context_chunks, sources = self._format_search_results(search_results)
+        context = "\n\n".join(context_chunks)
+        
+        if chat_history is None:
+            # Create system prompt
+            system_prompt = f"""You are an AI assistant helping users understand a document titled "{document_info['filename']}".
+
+You will be provided with relevant excerpts from the document and a user question. Your task is to:
+1. Answer the question based ONLY on the provided context
+2. Be accurate and specific
+3. If the context doesn't contain enough information to answer the question, say so clearly
+4. Cite specific parts of the context when possible
+5. Keep your answer concise but comprehensive
+
+Document context:
+{context}
+
+Remember: Only use information from the provided context. Do not add information from your general knowledge."""
+            user_message = f"Question: {query}"
+        else:
             # Create system prompt with history
             system_prompt = f"""You are an AI assistant helping users understand a document titled "{document_info['filename']}".
 
@@ -175,45 +567,87 @@ Current document context:
 {context}
 
 Answer the user's follow-up question based on the document context and previous conversation. Maintain consistency with previous responses while providing accurate information from the document."""
-            
-            answer = ""
+            user_message = f"Follow-up question: {query}"
+        
+        return {
+            'system_prompt': system_prompt,
+            'user_message': user_message,
+            'sources': sources,
+            'context_used': len(context_chunks)
+        }
+    
+    def _chat_request_body(self, system_prompt: str, user_message: str) -> Dict[str, Any]:
+        """Chat completion parameters shared by the direct, streaming, async and Batch API paths"""
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_message}
+            ],
+            "max_tokens": self.max_response_tokens,
+            "temperature": 0.1
+        }
+    
+    def _generate(self, system_prompt: str, user_message: str) -> str:
+        """Generate a complete answer with the configured provider"""
+        if self.provider == "openai":
+            # Generate response with OpenAI
+            if self.openai_client and self.model:
+                response = self.openai_client.chat.completions.create(**self._chat_request_body(system_prompt, user_message))
+                return response.choices[0].message.content or "No response generated."
+            return "OpenAI not properly configured."
+        
+        elif self.provider == "google":
+            # Generate response with Google Gemini
+            if self.google_client and self.model:
+                try:
+                    prompt = f"{system_prompt}\n\n{user_message}"
+                    model = self.google_client.GenerativeModel(self.model)
+                    response = model.generate_content(prompt)
+                    return response.text or "I couldn't generate a response."
+                except Exception as e:
+                    raise ProviderError(f"Google Gemini error: {str(e)}")
+            return "Google Gemini not properly configured."
+        
+        return ""
+    
+    async def _agenerate(self, system_prompt: str, user_message: str, openai_client: Optional[AsyncOpenAI]) -> str:
+        """Async variant of _generate"""
+        if self.provider == "openai":
+            if openai_client and self.model:
+                response = await openai_client.chat.completions.create(**self._chat_request_body(system_prompt, user_message))
+                return response.choices[0].message.content or "No response generated."
+            return "OpenAI not properly configured."
+        
+        # The Gemini SDK call is blocking, so run it off the event loop
+        return await asyncio.to_thread(self._generate, system_prompt, user_message)
+    
+    def _generate_stream(self, system_prompt: str, user_message: str) -> Iterator[str]:
+        """Yield the answer incrementally as the provider streams it back"""
+        try:
             if self.provider == "openai":
-                # Generate response with OpenAI
                 if self.openai_client and self.model:
-                    response = self.openai_client.chat.completions.create(
-                        model=self.model,
-                        messages=[
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": f"Follow-up question: {query}"}
-                        ],
-                        max_tokens=1000,
-                        temperature=0.1
+                    stream = self.openai_client.chat.completions.create(
+                        **self._chat_request_body(system_prompt, user_message), stream=True
                     )
-                    answer = response.choices[0].message.content or "No response generated."
+                    for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            yield chunk.choices[0].delta.content
                 else:
-                    answer = "OpenAI not properly configured."
-                
+                    yield "OpenAI not properly configured."
+            
             elif self.provider == "google":
-                # Generate response with Google Gemini
                 if self.google_client and self.model:
                     try:
-                        prompt = f"{system_prompt}\n\nFollow-up question: {query}"
+                        prompt = f"{system_prompt}\n\n{user_message}"
                         model = self.google_client.GenerativeModel(self.model)
-                        response = model.generate_content(prompt)
-                        answer = response.text or "I couldn't generate a response."
+                        for chunk in model.generate_content(prompt, stream=True):
+                            if chunk.text:
+                                yield chunk.text
                     except Exception as e:
-                        answer = f"Google Gemini error: {str(e)}"
+                        yield f"Google Gemini error: {str(e)}"
                 else:
-                    answer = "Google Gemini not properly configured."
-            
-            return {
-                'answer': answer,
-                'sources': sources,
-                'context_used': len(context_chunks)
-            }
-            
+                    yield "Google Gemini not properly configured."
+        
         except Exception as e:
-            return {
-                'answer': f"I encountered an error while processing your question: {str(e)}",
-                'sources': []
-            }
+            yield f"I encountered an error while processing your question: {str(e)}"
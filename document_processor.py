@@ -1,11 +1,61 @@
 import streamlit as st
-import fitz  # PyMuPDF
-import markdown
-from bs4 import BeautifulSoup
+import hashlib
+import html
+import importlib.util
+import io
+import os
+import shutil
+import tempfile
+import time
 import uuid
 import re
+import numpy as np
 from datetime import datetime
-from typing import Dict, List, Any
+from pathlib import Path
+from typing import Dict, List, Any, Optional
+
+from utils import dump_json_bytes, load_json_bytes, get_token_encoding
+
+# PyMuPDF and BeautifulSoup are imported where they are used so
+# that importing this module (every Streamlit cold start) stays cheap.
+# Use the C-backed lxml parser for BeautifulSoup when it is installed.
+_HTML_PARSER = 'lxml' if importlib.util.find_spec('lxml') else 'html.parser'
+
+# Part of every processed-document cache file name; bump it whenever extraction or
+# chunking output changes so results cached by older code are never served
+_CACHE_VERSION = 2
+
+_WS_RE = re.compile(r'\s+')
+_PUNCT_RE = re.compile(r'[^\w\s\.\,\!\?\;\:\-\(\)]')
+
+# Markdown syntax to strip, applied in order, leaving the text a reader would see
+_MD_SUBS = [
+    (re.compile(r'^[ \t]*(?:```|~~~).*$', re.M), ''),                    # code fences
+    (re.compile(r'^[ \t]*\[[^\]]+\]:[ \t]*\S+.*$', re.M), ''),             # reference definitions
+    (re.compile(r'^[ \t]*(?:[-*_][ \t]*){3,}$', re.M), ''),               # horizontal rules
+    (re.compile(r'^[ \t]*(?:=+|-+)[ \t]*$', re.M), ''),                   # setext heading underlines
+    (re.compile(r'!\[([^\]]*)\]\([^)]*\)'), r'\1'),                       # images -> alt text
+    (re.compile(r'\[([^\]]+)\](?:\([^)]*\)|\[[^\]]*\])'), r'\1'),            # links -> link text
+    (re.compile(r'<((?:https?|ftp|mailto):[^>\s]+)>'), r'\1'),               # autolinks -> URL
+    (re.compile(r'<!--.*?-->', re.S), ''),                                 # HTML comments
+    (re.compile(r'</?[A-Za-z][^>\n]*>'), ''),                             # inline HTML tags
+    (re.compile(r'^[ \t]{0,3}#{1,6}[ \t]+(.*?)[ \t#]*$', re.M), r'\1'),     # ATX headings
+    (re.compile(r'^[ \t]*(?:>[ \t]?)+', re.M), ''),                        # blockquotes
+    (re.compile(r'^([ \t]*)(?:[-*+]|\d+[.)])[ \t]+', re.M), r'\1'),         # list markers
+    (re.compile(r'(`+)(.+?)\1', re.S), r'\2'),                             # inline code
+    (re.compile(r'(\*\*|__)(?=\S)(.+?)(?<=\S)\1', re.S), r'\2'),           # bold
+    (re.compile(r'(?<![\w*])\*(?=\S)(.+?)(?<=\S)\*(?![\w*])', re.S), r'\1'),  # italic *
+    (re.compile(r'(?<!\w)_(?=\S)(.+?)(?<=\S)_(?!\w)', re.S), r'\1'),        # italic _
+    (re.compile(r'~~(.+?)~~', re.S), r'\1'),                               # strikethrough
+]
+
+
+
+def _find_chunk_boundaries(n_words: int, window: int, step: int) -> np.ndarray:
+    """Return (start, end) word offsets of every overlapping chunk window"""
+    starts = np.arange(0, n_words, step)
+    ends = np.minimum(starts + window, n_words)
+    return np.stack((starts, ends), axis=1)
 
 
 class DocumentProcessor:
@@ -13,32 +63,42 @@ class DocumentProcessor:
     def __init__(self):
         self.chunk_size = 500  # tokens
         self.chunk_overlap = 50  # tokens
+        # Extracted text and chunks keyed by file content, so re-uploads skip parsing
+        self.cache_dir = Path(tempfile.gettempdir()) / "docquery_cache"
+        self.cache_max_age = 7 * 24 * 3600  # seconds since an entry was last used
+        self.cache_max_bytes = 256 * 1024 * 1024
 
     def process_document(self, uploaded_file) -> Dict[str, Any]:
         """Process uploaded document and return chunks with metadata"""
         try:
             file_extension = uploaded_file.name.split('.')[-1].lower()
-
-            if file_extension == 'pdf':
-                text = self._extract_pdf_text(uploaded_file)
-            elif file_extension == 'md':
-                text = self._extract_markdown_text(uploaded_file)
-            elif file_extension in ['html', 'htm']:
-                text = self._extract_html_text(uploaded_file)
-            else:
+            if file_extension not in ('pdf', 'md', 'html', 'htm'):
                 return {
                     'success': False,
                     'error': f'Unsupported file type: {file_extension}'
                 }
 
-            if not text.strip():
-                return {
-                    'success': False,
-                    'error': 'No text content found in document'
-                }
-
-            # Create chunks
-            chunks = self._create_chunks(text)
+            content_hash = self._content_hash(uploaded_file)
+            cached = self._load_cached(content_hash)
+            if cached:
+                text, chunks = cached['text'], cached['chunks']
+            else:
+                if file_extension == 'pdf':
+                    text = self._extract_pdf_text(uploaded_file)
+                elif file_extension == 'md':
+                    text = self._extract_markdown_text(uploaded_file)
+                else:
+                    text = self._extract_html_text(uploaded_file)
+
+                if not text.strip():
+                    return {
+                        'success': False,
+                        'error': 'No text content found in document'
+                    }
+
+                # Create chunks
+                chunks = self._create_chunks(text)
+                self._store_cached(content_hash, text, chunks)
 
             # Create metadata
             metadata = {
@@ -47,7 +107,8 @@ class DocumentProcessor:
                 'file_type': file_extension,
                 'processed_date': datetime.now().isoformat(),
                 'total_chars': len(text),
-                'total_chunks': len(chunks)
+                'total_chunks': len(chunks),
+                'content_hash': content_hash
             }
 
             return {
@@ -60,23 +121,92 @@ class DocumentProcessor:
         except Exception as e:
             return {'success': False, 'error': str(e)}
 
-    def _extract_pdf_text(self, uploaded_file) -> str:
-        """Extract text from PDF file"""
+    def process_document_bytes(self, file_bytes: bytes, filename: str) -> Dict[str, Any]:
+        """Process a document from its raw bytes and filename"""
+        buffer = io.BytesIO(file_bytes)
+        buffer.name = filename
+        return self.process_document(buffer)
+
+    def _content_hash(self, uploaded_file) -> str:
+        """BLAKE2b digest of the file contents (the read position is reset afterwards)"""
+        uploaded_file.seek(0)
+        digest = hashlib.file_digest(uploaded_file, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
+        uploaded_file.seek(0)
+        return digest
+
+    def _cache_path(self, content_hash: str) -> Path:
+        """Cache file for a document; the cache version and chunking settings are part of the name"""
+        mode = 'tokens' if get_token_encoding() is not None else 'words'
+        return self.cache_dir / f"v{_CACHE_VERSION}_{content_hash}_{self.chunk_size}_{self.chunk_overlap}_{mode}.json"
+
+    def _load_cached(self, content_hash: str) -> Optional[Dict[str, Any]]:
+        """Return the cached text and chunks for this content, or None"""
+        path = self._cache_path(content_hash)
         try:
-            # Read PDF bytes
-            pdf_bytes = uploaded_file.read()
-
-            # Open PDF with PyMuPDF
-            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+            cached = load_json_bytes(path.read_bytes())
+            os.utime(path)  # mark as recently used for _prune_cache
+            return cached
+        except (OSError, ValueError):
+            return None
+
+    def _store_cached(self, content_hash: str, text: str, chunks: List[Dict[str, Any]]):
+        """Cache text and chunks; failures only cost a re-parse next time"""
+        path = self._cache_path(content_hash)
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # Write aside and rename so a concurrent reader never sees a partial file
+            tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            tmp_path.write_bytes(dump_json_bytes({'text': text, 'chunks': chunks}))
+            os.replace(tmp_path, path)
+            self._prune_cache()
+        except OSError:
+            pass
+
+    def _prune_cache(self):
+        """Delete cache entries from older cache versions or unused for cache_max_age,
+        then the least recently used ones until the cache fits in cache_max_bytes"""
+        now = time.time()
+        prefix = f"v{_CACHE_VERSION}_"
+        entries = []  # (last used, size, path)
+        for entry in os.scandir(self.cache_dir):
+            try:
+                stat = entry.stat()
+                if not entry.name.startswith(prefix) or now - stat.st_mtime > self.cache_max_age:
+                    os.remove(entry.path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except OSError:
+                pass  # e.g. removed by another process meanwhile
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.cache_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
 
-            text = ""
-            for page_num in range(len(doc)):
-                page = doc.load_page(page_num)
-                text += page.get_text()
-                text += "\n\n"  # Add page separator
+    def _extract_pdf_text(self, uploaded_file) -> str:
+        """Extract text from PDF file"""
+        import fitz  # PyMuPDF
 
-            doc.close()
-            return text
+        try:
+            # Spool the upload to a temporary file in blocks rather than
+            # materializing a second full copy of the PDF as bytes
+            with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+                shutil.copyfileobj(uploaded_file, tmp)
+                tmp_path = tmp.name
+
+            try:
+                # Open PDF with PyMuPDF from the file path
+                with fitz.open(tmp_path, filetype="pdf") as doc:
+                    # Join once instead of growing a string page by page
+                    # (each page is followed by a separator)
+                    return "".join(f"{page.get_text()}\n\n" for page in doc)
+            finally:
+                os.remove(tmp_path)
 
         except Exception as e:
             raise Exception(f"Error extracting PDF text: {str(e)}")
@@ -85,41 +215,34 @@ class DocumentProcessor:
         """Extract text from Markdown file"""
         try:
             # Read as string
-            content = uploaded_file.read().decode('utf-8')
-
-            # Convert Markdown to HTML
-            html = markdown.markdown(content)
+            text = uploaded_file.read().decode('utf-8')
 
-            # Extract plain text from HTML
-            soup = BeautifulSoup(html, 'html.parser')
-            text = soup.get_text()
+            # Strip Markdown syntax directly instead of rendering HTML and parsing it again
+            for pattern, replacement in _MD_SUBS:
+                text = pattern.sub(replacement, text)
 
-            return text
+            return html.unescape(text)
 
         except Exception as e:
             raise Exception(f"Error extracting Markdown text: {str(e)}")
 
     def _extract_html_text(self, uploaded_file) -> str:
         """Extract text from HTML file"""
+        from bs4 import BeautifulSoup
+
         try:
             # Read as string
             content = uploaded_file.read().decode('utf-8')
 
             # Parse HTML
-            soup = BeautifulSoup(content, 'html.parser')
+            soup = BeautifulSoup(content, features=_HTML_PARSER)
 
             # Remove script and style elements
             for script in soup(["script", "style"]):
                 script.decompose()
 
-            # Get text
-            text = soup.get_text()
-
-            # Clean up whitespace
-            lines = (line.strip() for line in text.splitlines())
-            chunks = (phrase.strip() for line in lines
-                      for phrase in line.split("  "))
-            text = ' '.join(chunk for chunk in chunks if chunk)
+            # Get text and collapse whitespace in one regex pass
+            text = _WS_RE.sub(' ', soup.get_text()).strip()
 
             return text
 
@@ -127,40 +250,45 @@ class DocumentProcessor:
             raise Exception(f"Error extracting HTML text: {str(e)}")
 
     def _create_chunks(self, text: str) -> List[Dict[str, Any]]:
-        """Split text into chunks with overlap"""
-        # Simple word-based chunking (approximating tokens)
+        """Split text into chunks of chunk_size tokens with chunk_overlap tokens of overlap"""
+        encoding = get_token_encoding()
+        if encoding is None:
+            return self._create_word_chunks(text)
+
+        # Tokenize once, window in token space, then decode all windows in one call
+        ids = encoding.encode_ordinary(text)
+        step = max(1, self.chunk_size - self.chunk_overlap)
+        boundaries = _find_chunk_boundaries(len(ids), self.chunk_size, step).tolist()
+        texts = encoding.decode_batch([ids[start:end] for start, end in boundaries])
+
+        return [{
+            'text': chunk_text,
+            'chunk_id': chunk_id,
+            'start_token': start,
+            'end_token': end,
+            'token_count': end - start,
+            'word_count': len(chunk_text.split())
+        } for chunk_id, ((start, end), chunk_text) in enumerate(zip(boundaries, texts))]
+
+    def _create_word_chunks(self, text: str) -> List[Dict[str, Any]]:
+        """Split text into word-based chunks, approximating tokens (used without tiktoken)"""
         words = text.split()
-        chunks = []
-
-        chunk_size_words = self.chunk_size // 1.3  # Rough conversion from tokens to words
-        overlap_words = self.chunk_overlap // 1.3
-
-        for i in range(0, len(words), int(chunk_size_words - overlap_words)):
-            chunk_words = words[i:i + int(chunk_size_words)]
-            chunk_text = ' '.join(chunk_words)
-
-            if chunk_text.strip():
-                chunks.append({
-                    'text':
-                    chunk_text,
-                    'chunk_id':
-                    len(chunks),
-                    'start_word':
-                    i,
-                    'end_word':
-                    min(i + int(chunk_size_words), len(words)),
-                    'word_count':
-                    len(chunk_words)
-                })
-
-        return chunks
 
-    def _clean_text(self, text: str) -> str:
-        """Clean and normalize text"""
-        # Remove excessive whitespace
-        text = re.sub(r'\s+', ' ', text)
+        # Rough conversion from tokens to words, computed once
+        window = int(self.chunk_size // 1.3)
+        step = max(1, window - int(self.chunk_overlap // 1.3))
 
-        # Remove special characters but keep basic punctuation
-        text = re.sub(r'[^\w\s\.\,\!\?\;\:\-\(\)]', '', text)
+        # str.split() never yields empty words, so every window has text
+        return [{
+            'text': ' '.join(words[start:end]),
+            'chunk_id': chunk_id,
+            'start_word': start,
+            'end_word': end,
+            'word_count': end - start
+        } for chunk_id, (start, end) in enumerate(
+            _find_chunk_boundaries(len(words), window, step).tolist())]
 
-        return text.strip()
+    def _clean_text(self, text: str) -> str:
+        """Clean and normalize text"""
+        # Remove excessive whitespace, then special characters but keep basic punctuation
+        return _PUNCT_RE.sub('', _WS_RE.sub(' ', text)).strip()
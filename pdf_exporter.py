@@ -1,33 +1,47 @@
-import os
+import html
 import tempfile
+import threading
 from datetime import datetime
 from typing import List, Dict
-from reportlab.lib.pagesizes import letter, A4
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.enums import TA_LEFT, TA_CENTER
-from reportlab.lib.units import inch
+
+# reportlab is imported on first export rather than at module import, so the
+# chat path never pays for loading the PDF libraries
 
 class PDFExporter:
     def __init__(self):
-        self.styles = getSampleStyleSheet()
-        self._setup_custom_styles()
+        self._styles = None
+        self._styles_lock = threading.Lock()
+    
+    @property
+    def styles(self):
+        """Paragraph styles, built on first use"""
+        if self._styles is None:
+            with self._styles_lock:
+                if self._styles is None:
+                    from reportlab.lib.styles import getSampleStyleSheet
+                    styles = getSampleStyleSheet()
+                    self._setup_custom_styles(styles)
+                    self._styles = styles
+        return self._styles
     
-    def _setup_custom_styles(self):
+    def _setup_custom_styles(self, styles):
         """Setup custom styles for PDF generation"""
+        from reportlab.lib.styles import ParagraphStyle
+        from reportlab.lib.enums import TA_CENTER
+        
         # Title style
-        self.styles.add(ParagraphStyle(
+        styles.add(ParagraphStyle(
             name='CustomTitle',
-            parent=self.styles['Title'],
+            parent=styles['Title'],
             fontSize=18,
             spaceAfter=20,
             alignment=TA_CENTER
         ))
         
         # Question style
-        self.styles.add(ParagraphStyle(
+        styles.add(ParagraphStyle(
             name='Question',
-            parent=self.styles['Normal'],
+            parent=styles['Normal'],
             fontSize=12,
             textColor='#2E86AB',
             spaceBefore=15,
@@ -36,9 +50,9 @@ class PDFExporter:
         ))
         
         # Answer style
-        self.styles.add(ParagraphStyle(
+        styles.add(ParagraphStyle(
             name='Answer',
-            parent=self.styles['Normal'],
+            parent=styles['Normal'],
             fontSize=11,
             spaceBefore=5,
             spaceAfter=10,
@@ -46,9 +60,9 @@ class PDFExporter:
         ))
         
         # Source style
-        self.styles.add(ParagraphStyle(
+        styles.add(ParagraphStyle(
             name='Source',
-            parent=self.styles['Normal'],
+            parent=styles['Normal'],
             fontSize=9,
             textColor='#666666',
             spaceBefore=5,
@@ -57,9 +71,9 @@ class PDFExporter:
         ))
         
         # Metadata style
-        self.styles.add(ParagraphStyle(
+        styles.add(ParagraphStyle(
             name='Metadata',
-            parent=self.styles['Normal'],
+            parent=styles['Normal'],
             fontSize=10,
             textColor='#888888',
             spaceAfter=20,
@@ -68,11 +82,14 @@ class PDFExporter:
     
     def export_chat(self, messages: List[Dict], document_name: str) -> str:
         """Export chat messages to PDF"""
+        from reportlab.lib.pagesizes import A4
+        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+        
         try:
-            # Create temporary file
-            temp_dir = tempfile.gettempdir()
+            # Create temporary file (unique, so concurrent exports never collide)
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            pdf_path = os.path.join(temp_dir, f"chat_export_{timestamp}.pdf")
+            with tempfile.NamedTemporaryFile(prefix=f"chat_export_{timestamp}_", suffix=".pdf", delete=False) as tmp:
+                pdf_path = tmp.name
             
             # Create PDF document
             doc = SimpleDocTemplate(
@@ -84,43 +101,43 @@ class PDFExporter:
                 bottomMargin=18
             )
             
-            # Build content
-            story = []
+            # Resolve styles once instead of per paragraph
+            styles = self.styles
+            question_style = styles['Question']
+            answer_style = styles['Answer']
+            source_style = styles['Source']
             
-            # Title
-            title = f"Chat Export: {document_name}"
-            story.append(Paragraph(title, self.styles['CustomTitle']))
-            
-            # Metadata
+            # Title, metadata and separator
             export_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            metadata = f"Exported on {export_time}"
-            story.append(Paragraph(metadata, self.styles['Metadata']))
-            
-            # Add separator
-            story.append(Spacer(1, 20))
+            story = [
+                Paragraph(f"Chat Export: {document_name}", styles['CustomTitle']),
+                Paragraph(f"Exported on {export_time}", styles['Metadata']),
+                Spacer(1, 20)
+            ]
             
             # Process messages
             qa_pairs = self._group_messages_into_qa_pairs(messages)
+            escape = self._escape_html
             
-            for i, (question, answer) in enumerate(qa_pairs, 1):
-                # Question
-                question_text = f"<b>Q{i}:</b> {self._escape_html(question['content'])}"
-                story.append(Paragraph(question_text, self.styles['Question']))
-                
-                # Answer
-                answer_text = f"<b>A{i}:</b> {self._escape_html(answer['content'])}"
-                story.append(Paragraph(answer_text, self.styles['Answer']))
+            def qa_flowables(i, question, answer):
+                yield Paragraph(f"<b>Q{i}:</b> {escape(question['content'])}", question_style)
+                yield Paragraph(f"<b>A{i}:</b> {escape(answer['content'])}", answer_style)
                 
                 # Sources (if available)
-                if 'sources' in answer and answer['sources']:
-                    story.append(Paragraph("<b>Sources:</b>", self.styles['Source']))
-                    for source in answer['sources']:
-                        source_text = f"• {self._escape_html(source)}"
-                        story.append(Paragraph(source_text, self.styles['Source']))
+                sources = answer.get('sources')
+                if sources:
+                    yield Paragraph("<b>Sources:</b>", source_style)
+                    yield from (Paragraph(f"• {escape(source)}", source_style) for source in sources)
                 
                 # Add space between Q&A pairs
                 if i < len(qa_pairs):
-                    story.append(Spacer(1, 15))
+                    yield Spacer(1, 15)
+            
+            story.extend(
+                flowable
+                for i, (question, answer) in enumerate(qa_pairs, 1)
+                for flowable in qa_flowables(i, question, answer)
+            )
             
             # Build PDF
             doc.build(story)
@@ -149,51 +166,52 @@ class PDFExporter:
         if not text:
             return ""
         
-        # Replace HTML entities
-        text = text.replace('&', '&amp;')
-        text = text.replace('<', '&lt;')
-        text = text.replace('>', '&gt;')
-        text = text.replace('"', '&quot;')
-        text = text.replace("'", '&#x27;')
-        
-        # Handle line breaks
-        text = text.replace('\n', '<br/>')
-        
-        return text
+        # Replace HTML entities (&, <, >, " and ' in one pass), then handle line breaks
+        return html.escape(text, quote=True).replace('\n', '<br/>')
     
     def export_document_summary(self, document_info: Dict, chunks_sample: List[str] = None) -> str:
         """Export document summary to PDF"""
+        from reportlab.lib.pagesizes import A4
+        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+        
         try:
-            # Create temporary file
-            temp_dir = tempfile.gettempdir()
+            # Create temporary file (unique, so concurrent exports never collide)
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            pdf_path = os.path.join(temp_dir, f"document_summary_{timestamp}.pdf")
+            with tempfile.NamedTemporaryFile(prefix=f"document_summary_{timestamp}_", suffix=".pdf", delete=False) as tmp:
+                pdf_path = tmp.name
             
             # Create PDF document
             doc = SimpleDocTemplate(pdf_path, pagesize=A4)
-            story = []
-            
-            # Title
-            title = f"Document Summary: {document_info['filename']}"
-            story.append(Paragraph(title, self.styles['CustomTitle']))
-            
-            # Document metadata
-            story.append(Paragraph("<b>File Information:</b>", self.styles['Heading2']))
-            story.append(Paragraph(f"Filename: {document_info['filename']}", self.styles['Normal']))
-            story.append(Paragraph(f"Type: {document_info['file_type']}", self.styles['Normal']))
-            story.append(Paragraph(f"Upload Date: {document_info['upload_date']}", self.styles['Normal']))
-            story.append(Paragraph(f"Size: {document_info['size']}", self.styles['Normal']))
-            story.append(Paragraph(f"Total Chunks: {document_info['chunks_count']}", self.styles['Normal']))
             
-            story.append(Spacer(1, 20))
+            # Resolve styles once instead of per paragraph
+            styles = self.styles
+            heading_style = styles['Heading2']
+            normal_style = styles['Normal']
+            
+            # Title and document metadata
+            story = [
+                Paragraph(f"Document Summary: {document_info['filename']}", styles['CustomTitle']),
+                Paragraph("<b>File Information:</b>", heading_style),
+                Paragraph(f"Filename: {document_info['filename']}", normal_style),
+                Paragraph(f"Type: {document_info['file_type']}", normal_style),
+                Paragraph(f"Upload Date: {document_info['upload_date']}", normal_style),
+                Paragraph(f"Size: {document_info['size']}", normal_style),
+                Paragraph(f"Total Chunks: {document_info['chunks_count']}", normal_style),
+                Spacer(1, 20)
+            ]
             
             # Sample chunks if provided
             if chunks_sample:
-                story.append(Paragraph("<b>Content Sample:</b>", self.styles['Heading2']))
-                for i, chunk in enumerate(chunks_sample[:3], 1):
-                    story.append(Paragraph(f"<b>Chunk {i}:</b>", self.styles['Normal']))
-                    story.append(Paragraph(self._escape_html(chunk[:500] + "..." if len(chunk) > 500 else chunk), self.styles['Normal']))
-                    story.append(Spacer(1, 10))
+                story.append(Paragraph("<b>Content Sample:</b>", heading_style))
+                story.extend(
+                    flowable
+                    for i, chunk in enumerate(chunks_sample[:3], 1)
+                    for flowable in (
+                        Paragraph(f"<b>Chunk {i}:</b>", normal_style),
+                        Paragraph(self._escape_html(chunk[:500] + "..." if len(chunk) > 500 else chunk), normal_style),
+                        Spacer(1, 10)
+                    )
+                )
             
             # Build PDF
             doc.build(story)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from utils import ensure_dir
+from vector_store import VectorStore
+
+
+def _ivfpq_store() -> VectorStore:
+    """A small IVF-PQ store that needs no embedding API"""
+    store = VectorStore(provider="openai", index_type="ivfpq")
+    store.dimension = 32
+    store.ivfpq_min_vectors = 1000
+    store.ivfpq_m = 8
+    return store
+
+
+def _normalized(n: int, dimension: int, seed: int) -> np.ndarray:
+    vectors = np.random.default_rng(seed).random((n, dimension), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture(autouse=True)
+def _in_tmp_dir(tmp_path, monkeypatch):
+    # Stores are written under data/vectors relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    ensure_dir.cache_clear()
+
+
+def test_append_to_reloaded_ivfpq_store():
+    embeddings = _normalized(2000, 32, seed=0)
+    chunks = [{'text': f"chunk {i}", 'chunk_id': i} for i in range(len(embeddings))]
+    _ivfpq_store()._index_document(chunks, {'id': 'doc', 'total_chunks': len(chunks)}, embeddings)
+
+    store = _ivfpq_store()
+    store.load_document('doc')
+    assert store._index_mmapped
+
+    extra = _normalized(3, 32, seed=1)
+    store._index_document([{'text': f"extra {i}"} for i in range(3)], {'id': 'doc'}, extra)
+    assert store.index.ntotal == 2003
+    assert len(store.chunks) == 2003
+    assert store.metadata['total_chunks'] == 2003
+
+    reloaded = _ivfpq_store()
+    reloaded.load_document('doc')
+    assert reloaded.index.ntotal == 2003
+    assert len(reloaded.chunks) == 2003
+    assert reloaded.chunks[2002] == {'text': "extra 2", 'chunk_id': 2002}
+
+
+def test_failed_append_leaves_saved_store_untouched(monkeypatch):
+    embeddings = _normalized(2000, 32, seed=0)
+    chunks = [{'text': f"chunk {i}", 'chunk_id': i} for i in range(len(embeddings))]
+    _ivfpq_store()._index_document(chunks, {'id': 'doc', 'total_chunks': len(chunks)}, embeddings)
+
+    store = _ivfpq_store()
+    store.load_document('doc')
+
+    def fail(path):
+        raise OSError("disk full")
+    monkeypatch.setattr(store, "_write_metadata", fail)
+    with pytest.raises(Exception, match="disk full"):
+        store._index_document([{'text': "extra"}], {'id': 'doc'}, _normalized(1, 32, seed=1))
+    assert (store.index.ntotal, len(store.chunks)) == (2000, 2000)
+
+    reloaded = _ivfpq_store()
+    reloaded.load_document('doc')
+    assert (reloaded.index.ntotal, len(reloaded.chunks)) == (2000, 2000)
+    assert reloaded.metadata['total_chunks'] == 2000
@@ -16,14 +16,20 @@ class ThemeManager:
                 'secondary_color': '#4ECDC4'
             }
         }
+        
+        # Render each theme's CSS once; applying a theme is then a dict lookup
+        self._css_cache = {name: self._render_css(theme) for name, theme in self.themes.items()}
     
     def apply_theme(self, theme_name: str):
         """Apply the selected theme using custom CSS"""
-        if theme_name not in self.themes:
-            theme_name = 'light'
-        
-        theme = self.themes[theme_name]
-        
+        st.markdown(self.get_css(theme_name), unsafe_allow_html=True)
+    
+    def get_css(self, theme_name: str) -> str:
+        """Get the pre-rendered CSS for a theme"""
+        return self._css_cache.get(theme_name, self._css_cache['light'])
+    
+    def _render_css(self, theme: dict) -> str:
+        """Render the CSS for a theme"""
         # Enhanced CSS for better theming
         css = f"""
         <style>
@@ -131,7 +137,7 @@ class ThemeManager:
         </style>
         """
         
-        st.markdown(css, unsafe_allow_html=True)
+        return css
     
     def get_theme_icon(self, current_theme: str) -> str:
         """Get the appropriate icon for theme toggle"""
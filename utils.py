@@ -1,7 +1,76 @@
 import os
+import re
 import json
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Awaitable, FrozenSet, Iterable, Tuple
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient, DefaultAioHttpClient
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_INVALID_FILENAME_RE = re.compile(r'[<>:"/\\|?*]')
+_UNDERSCORES_RE = re.compile(r'_+')
+_WS_RE = re.compile(r'\s+')
+# clean_text_for_embedding in one scan: a whitespace run or one special character
+# becomes a space (group 1), and runs of dots (group 2) or commas (group 3) collapse
+_EMBEDDING_CLEAN_RE = re.compile(r'(\s+|[^\w\s\.\,\!\?\;\:\-\(\)])|(\.{2,})|(,{2,})')
+_EMBEDDING_CLEAN_REPL = (None, ' ', '.', ',')
+
+@functools.lru_cache(maxsize=None)
+def ensure_dir(directory: str):
+    """Create a directory (and parents) once per process; later calls make no syscalls.
+    
+    Call ensure_dir.cache_clear() if directories may be removed while the app runs.
+    """
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+@functools.lru_cache(maxsize=None)
+def get_openai_client(api_key: str) -> OpenAI:
+    """Process-wide OpenAI client whose keep-alive pool is shared by every
+    ChatManager and VectorStore using the same API key.
+    
+    Call get_openai_client.cache_clear() in a child after forking: the
+    pooled connections must not be shared across processes.
+    """
+    http_client = DefaultHttpxClient(
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30.0)
+    )
+    return OpenAI(api_key=api_key, http_client=http_client)
+
+def make_async_openai_client(api_key: str, **options) -> AsyncOpenAI:
+    """AsyncOpenAI client for concurrent fan-out, on the aiohttp transport when installed.
+    
+    httpx's async connection pool stops scaling well before aiohttp's once many
+    requests are in flight. Without the openai[aiohttp] extra, fall back to httpx
+    with a pool sized for many requests in flight. A new client is made per event loop, since
+    aiohttp sessions are bound to the loop that created them. Extra options (e.g.
+    max_retries) are passed to AsyncOpenAI.
+    """
+    try:
+        http_client = DefaultAioHttpClient()
+    except RuntimeError:
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_keepalive_connections=100, max_connections=200, keepalive_expiry=30.0)
+        )
+    return AsyncOpenAI(api_key=api_key, http_client=http_client, **options)
 
 def ensure_directories():
     """Ensure all required directories exist"""
@@ -12,7 +81,27 @@ def ensure_directories():
     ]
     
     for directory in directories:
-        os.makedirs(directory, exist_ok=True)
+        ensure_dir(directory)
+
+def run_async(coro: Awaitable) -> Any:
+    """Run a coroutine to completion from synchronous code and return its result.
+    
+    Uses a uvloop event loop when uvloop is installed (cheaper I/O polling for
+    many concurrent API calls). The loop is private to this call rather than a
+    global event loop policy, so Streamlit's own loop is never affected; if a
+    loop is already running in this thread the coroutine runs in a worker thread.
+    """
+    def run():
+        loop_factory = uvloop.new_event_loop if uvloop is not None else None
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            return runner.run(coro)
+    
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return run()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(run).result()
 
 def format_file_size(size_bytes: int) -> str:
     """Convert bytes to human readable format"""
@@ -20,12 +109,10 @@ def format_file_size(size_bytes: int) -> str:
         return "0 B"
     
     size_names = ["B", "KB", "MB", "GB", "TB"]
-    i = 0
-    while size_bytes >= 1024 and i < len(size_names) - 1:
-        size_bytes = int(size_bytes / 1024.0)
-        i += 1
+    # Each unit is 2**10 of the previous, so the bit length picks the unit directly
+    i = min(max(int(size_bytes).bit_length() - 1, 0) // 10, len(size_names) - 1)
     
-    return f"{size_bytes:.1f} {size_names[i]}"
+    return f"{size_bytes / (1 << (10 * i)):.1f} {size_names[i]}"
 
 def format_timestamp(timestamp_str: str) -> str:
     """Format ISO timestamp to readable format"""
@@ -35,60 +122,116 @@ def format_timestamp(timestamp_str: str) -> str:
     except:
         return timestamp_str
 
+def parse_timestamp(timestamp_str: str) -> float:
+    """Convert an ISO timestamp to a Unix timestamp (0.0 if it can't be parsed)"""
+    try:
+        return datetime.fromisoformat(timestamp_str).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
 def sanitize_filename(filename: str) -> str:
     """Sanitize filename for safe storage"""
-    import re
     # Remove or replace invalid characters
-    filename = re.sub(r'[<>:"/\\|?*]', '_', filename)
+    filename = _INVALID_FILENAME_RE.sub('_', filename)
     # Remove multiple underscores
-    filename = re.sub(r'_+', '_', filename)
+    filename = _UNDERSCORES_RE.sub('_', filename)
     # Remove leading/trailing underscores and dots
     filename = filename.strip('_.')
     
     return filename if filename else "unnamed_file"
 
+def dump_json_bytes(data: Any, pretty: bool = False) -> bytes:
+    """Serialize data to UTF-8 JSON bytes using the fastest available backend"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if pretty else 0)
+    if ujson is not None:
+        return ujson.dumps(data, ensure_ascii=False, indent=2 if pretty else 0).encode('utf-8')
+    if pretty:
+        return json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def load_json_bytes(data) -> Any:
+    """Deserialize JSON from bytes or str using the fastest available backend"""
+    if orjson is not None:
+        return orjson.loads(data)
+    if ujson is not None:
+        return ujson.loads(data)
+    return json.loads(data)
+
 def load_json_data(file_path: str, default: Any = None) -> Any:
     """Safely load JSON data from file"""
     try:
-        if os.path.exists(file_path):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+        # Hand the raw bytes to the parser; orjson/ujson decode UTF-8 themselves
+        with open(file_path, 'rb') as f:
+            return load_json_bytes(f.read())
+    except FileNotFoundError:
         return default if default is not None else []
     except Exception as e:
         print(f"Error loading JSON from {file_path}: {str(e)}")
         return default if default is not None else []
 
-def save_json_data(file_path: str, data: Any) -> bool:
-    """Safely save JSON data to file"""
+def save_json_data(file_path: str, data: Any, pretty: bool = False) -> bool:
+    """Safely save JSON data to file (compact unless pretty=True)"""
     try:
         # Ensure directory exists
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        ensure_dir(os.path.dirname(file_path))
         
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        # Serialize in one call and write once instead of streaming many small writes
+        with open(file_path, 'wb') as f:
+            f.write(dump_json_bytes(data, pretty=pretty))
         return True
     except Exception as e:
         print(f"Error saving JSON to {file_path}: {str(e)}")
         return False
 
+def append_jsonl_record(file_path: str, record: Any) -> bool:
+    """Append a single record to a JSON Lines file"""
+    try:
+        # Ensure directory exists
+        ensure_dir(os.path.dirname(file_path))
+        
+        with open(file_path, 'ab') as f:
+            f.write(dump_json_bytes(record) + b'\n')
+        return True
+    except Exception as e:
+        print(f"Error appending JSON line to {file_path}: {str(e)}")
+        return False
+
+def load_jsonl_data(file_path: str) -> List[Any]:
+    """Safely load all records from a JSON Lines file"""
+    records = []
+    try:
+        with open(file_path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    records.append(load_json_bytes(line))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Error loading JSON lines from {file_path}: {str(e)}")
+    return records
+
 def truncate_text(text: str, max_length: int = 100) -> str:
     """Truncate text to specified length with ellipsis"""
     if len(text) <= max_length:
         return text
-    return text[:max_length-3] + "..."
+    return f"{text[:max_length-3]}..."
 
 def extract_text_preview(text: str, length: int = 200) -> str:
     """Extract a clean preview of text content"""
-    # Remove excessive whitespace
-    import re
-    text = re.sub(r'\s+', ' ', text)
-    text = text.strip()
+    # Remove excessive whitespace. Collapsing whitespace only shortens text, so the
+    # preview of a long text comes from a cleaned prefix rather than the whole text
+    window = 2 * length
+    cleaned = _WS_RE.sub(' ', text[:window]).strip()
+    if len(cleaned) <= length and len(text) > window:
+        # The prefix was mostly whitespace; clean the whole text after all
+        cleaned = _WS_RE.sub(' ', text).strip()
     
-    if len(text) <= length:
-        return text
+    if len(cleaned) <= length:
+        return cleaned
     
     # Try to break at word boundary
-    preview = text[:length]
+    preview = cleaned[:length]
     last_space = preview.rfind(' ')
     
     if last_space > length * 0.8:  # If we can break reasonably close to the end
@@ -111,32 +254,56 @@ def get_file_type_icon(file_type: str) -> str:
     
     return icons.get(file_type.lower(), '📄')
 
-def validate_file_type(filename: str, allowed_types: List[str]) -> bool:
+@functools.lru_cache(maxsize=None)
+def get_file_category(file_type: str) -> str:
+    """Get the document category (PDF, HTML, Markdown or Other) for a file type"""
+    file_type = file_type.lower()
+    if 'pdf' in file_type:
+        return 'PDF'
+    if 'html' in file_type or 'htm' in file_type:
+        return 'HTML'
+    if 'markdown' in file_type or file_type == 'md':
+        return 'Markdown'
+    return 'Other'
+
+@functools.lru_cache(maxsize=32)
+def _allowed_extensions(allowed_types: Tuple[str, ...]) -> FrozenSet[str]:
+    """Lower-cased set of allowed extensions, built once per distinct list"""
+    return frozenset(ext.lower() for ext in allowed_types)
+
+def validate_file_type(filename: str, allowed_types: Iterable[str]) -> bool:
     """Validate if file type is allowed"""
     if not filename:
         return False
     
-    file_extension = filename.split('.')[-1].lower()
-    return file_extension in [ext.lower() for ext in allowed_types]
+    file_extension = filename.rpartition('.')[2].lower()
+    return file_extension in _allowed_extensions(tuple(allowed_types))
 
 def clean_text_for_embedding(text: str) -> str:
     """Clean text for better embedding generation"""
-    import re
-    
-    # Remove excessive whitespace
-    text = re.sub(r'\s+', ' ', text)
-    
-    # Remove special characters but keep basic punctuation
-    text = re.sub(r'[^\w\s\.\,\!\?\;\:\-\(\)]', ' ', text)
-    
-    # Remove multiple consecutive punctuation
-    text = re.sub(r'[\.]{2,}', '.', text)
-    text = re.sub(r'[,]{2,}', ',', text)
+    # Collapse whitespace, replace special characters (keeping basic punctuation) and
+    # collapse repeated dots and commas in a single pass
+    text = _EMBEDDING_CLEAN_RE.sub(lambda m: _EMBEDDING_CLEAN_REPL[m.lastindex], text)
     
     return text.strip()
 
+@functools.lru_cache(maxsize=1)
+def get_token_encoding():
+    """Return the cl100k_base tokenizer, or None if tiktoken is unavailable"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # The BPE file is downloaded on first use; fall back when offline
+        return None
+
 def estimate_tokens(text: str) -> int:
-    """Estimate token count (rough approximation)"""
+    """Estimate token count (exact with tiktoken, rough approximation otherwise)"""
+    encoding = get_token_encoding()
+    if encoding is not None:
+        return len(encoding.encode_ordinary(text))
+    
     # Rough estimation: 1 token ≈ 0.75 words for English
     words = len(text.split())
     return int(words / 0.75)
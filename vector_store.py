@@ -2,32 +2,361 @@ import streamlit as st
 import numpy as np
 import faiss
 import os
+import re
 import json
+import hashlib
 import pickle
-from typing import List, Dict, Any, Tuple
-from openai import OpenAI
+import asyncio
+import functools
+import math
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict
+from collections.abc import Sequence
+from typing import List, Dict, Any, Tuple, Optional
+from openai import APIConnectionError
 try:
     import google.generativeai as genai
 except ImportError:
     genai = None
+from utils import dump_json_bytes, load_json_bytes, ensure_dir, get_openai_client, make_async_openai_client
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    """Read the server-suggested wait from an error response's headers"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    
+    # OpenAI reports reset times as durations such as "1s", "250ms" or "6m0s"
+    reset = headers.get("x-ratelimit-reset-requests") or headers.get("x-ratelimit-reset-tokens")
+    if reset:
+        units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", reset)
+        if parts:
+            return sum(float(value) * units[unit] for value, unit in parts)
+    return None
+
+def _is_retryable(error: Exception) -> bool:
+    """Whether a request may succeed if sent again: the statuses the OpenAI SDK retries
+    (408, 409, 429, 5xx), timeouts and dropped connections"""
+    if isinstance(error, (APIConnectionError, ConnectionError, asyncio.TimeoutError)):
+        return True
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    return isinstance(status, int) and (status in (408, 409, 429) or status >= 500)
+
+async def _with_retry_backoff(request, max_retries: int = 5, initial_delay: float = 1.0):
+    """Await request(), retrying rate limits, server errors and transport failures with
+    header-driven or exponential backoff"""
+    delay = initial_delay
+    for attempt in range(max_retries + 1):
+        try:
+            return await request()
+        except Exception as e:
+            if not _is_retryable(e) or attempt == max_retries:
+                raise
+            await asyncio.sleep(_retry_after_seconds(e) or delay)
+            delay *= 2
+
+class _PlainDataUnpickler(pickle.Unpickler):
+    """Unpickler for legacy stores that rejects every global, so only plain
+    dicts, lists, strings and numbers can be loaded and no code can run"""
+    
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"Refusing to load {module}.{name} from a vector store file")
+
+class _EmbeddingCache:
+    """Embedding vectors stored in SQLite as float16, keyed by a BLAKE2b hash of
+    (model, task type, text), so identical text is only ever sent to the API once.
+    
+    The most recently used vectors are also kept in an in-process LRU, so repeated
+    queries skip SQLite entirely. The table holds at most max_rows vectors; beyond
+    that the least recently used rows are deleted.
+    """
+    
+    _MAX_PARAMS = 500  # keys per SELECT, below SQLite's bound-parameter limit
+    
+    def __init__(self, path: str, max_rows: int = 100000, memory_entries: int = 2048):
+        ensure_dir(os.path.dirname(path))
+        self.max_rows = max_rows
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL, used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+        self._rows = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def key(model: str, task_type: str, text: str) -> bytes:
+        return hashlib.blake2b(f"{model}\0{task_type}\0{text}".encode(), digest_size=16).digest()
+    
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """Return the cached vector for each key that has one"""
+        found = {}
+        with self._lock:
+            to_read = []
+            for key in keys:
+                vector = self._memory.get(key)
+                if vector is None:
+                    to_read.append(key)
+                else:
+                    self._memory.move_to_end(key)
+                    found[key] = vector
+            try:
+                for start in range(0, len(to_read), self._MAX_PARAMS):
+                    batch = to_read[start:start + self._MAX_PARAMS]
+                    placeholders = ",".join("?" * len(batch))
+                    rows = self._conn.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                    ).fetchall()
+                    if rows:
+                        with self._conn:
+                            self._conn.executemany(
+                                "UPDATE embeddings SET used = ? WHERE key = ?", ((time.time(), key) for key, _ in rows)
+                            )
+                    for key, vector in rows:
+                        found[key] = self._remember(key, np.frombuffer(vector, dtype=np.float16))
+            except sqlite3.Error:
+                pass  # an unreadable cache only means more API calls
+        return found
+    
+    def put_many(self, keys: List[bytes], vectors: np.ndarray):
+        vectors = vectors.astype(np.float16)
+        now = time.time()
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                self._remember(key, vector)
+            try:
+                with self._conn:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO embeddings (key, vector, used) VALUES (?, ?, ?)",
+                        ((key, vector.tobytes(), now) for key, vector in zip(keys, vectors))
+                    )
+                self._rows += len(keys)  # an overestimate when keys were replaced
+                if self._rows > self.max_rows:
+                    self._prune()
+            except sqlite3.Error:
+                pass
+    
+    def _remember(self, key: bytes, vector: np.ndarray) -> np.ndarray:
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+        return vector
+    
+    def _prune(self):
+        """Delete the least recently used rows down to 90% of max_rows, so pruning
+        runs once per many inserts rather than on every one"""
+        rows = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        excess = rows - int(self.max_rows * 0.9)
+        if rows > self.max_rows:
+            with self._conn:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY used LIMIT ?)", (excess,)
+                )
+            rows -= excess
+        self._rows = rows
+
+@functools.lru_cache(maxsize=1)
+def _get_gpu_resources():
+    """Shared GPU scratch memory for all GPU indexes, or None without faiss-gpu and a CUDA device"""
+    if not hasattr(faiss, "StandardGpuResources") or faiss.get_num_gpus() == 0:
+        return None
+    return faiss.StandardGpuResources()
+
+@functools.lru_cache(maxsize=None)
+def _get_embedding_cache(path: str) -> _EmbeddingCache:
+    """One cache connection per database file, shared by all VectorStore instances"""
+    return _EmbeddingCache(path)
+
+class _SqliteChunks(Sequence):
+    """List view of a document's chunks stored in SQLite, one row per FAISS id.
+    
+    Only the row count is kept in memory: a search fetches the chunks it
+    returns with a single query, and appended chunks are inserted in place.
+    """
+    
+    _MAX_PARAMS = 500  # ids per SELECT, below SQLite's bound-parameter limit
+    _SCHEMA = "CREATE TABLE IF NOT EXISTS chunks (idx INTEGER PRIMARY KEY, text TEXT NOT NULL, meta BLOB NOT NULL)"
+    
+    def __init__(self, path: str):
+        self.path = path
+        # mode=rw: a missing file is an error rather than a new, empty store
+        self._conn = sqlite3.connect(f"file:{path}?mode=rw", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._len = self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+    
+    @classmethod
+    def write(cls, path: str, chunks):
+        """Write chunks to a new database file at path"""
+        if os.path.exists(path):
+            os.remove(path)
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute(cls._SCHEMA)
+            with conn:
+                conn.executemany("INSERT INTO chunks (idx, text, meta) VALUES (?, ?, ?)", cls._rows(chunks, 0))
+        finally:
+            conn.close()
+    
+    @classmethod
+    def create(cls, path: str, chunks) -> "_SqliteChunks":
+        """Write chunks to a new database at path, replacing any existing one"""
+        cls.write(f"{path}.tmp", chunks)
+        os.replace(f"{path}.tmp", path)
+        return cls(path)
+    
+    @staticmethod
+    def _rows(chunks, start: int):
+        for idx, chunk in enumerate(chunks, start):
+            meta = {key: value for key, value in chunk.items() if key != 'text'}
+            yield idx, chunk.get('text', ''), dump_json_bytes(meta)
+    
+    def __len__(self) -> int:
+        return self._len
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.get_many(range(*i.indices(len(self))))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("chunk index out of range")
+        return self.get_many([i])[0]
+    
+    def get_many(self, ids) -> List[Dict]:
+        """Return the chunks for ids, in order, fetching each distinct id once"""
+        ids = [int(i) for i in ids]
+        unique = list(dict.fromkeys(ids))
+        found = {}
+        with self._lock:
+            for start in range(0, len(unique), self._MAX_PARAMS):
+                batch = unique[start:start + self._MAX_PARAMS]
+                placeholders = ",".join("?" * len(batch))
+                for idx, text, meta in self._conn.execute(
+                    f"SELECT idx, text, meta FROM chunks WHERE idx IN ({placeholders})", batch
+                ):
+                    found[idx] = {'text': text, **load_json_bytes(meta)}
+        return [found[i] for i in ids]
+    
+    def write_extended(self, path: str, chunks: List[Dict]):
+        """Write a copy of this store with chunks appended to a new database file at path"""
+        if os.path.exists(path):
+            os.remove(path)
+        conn = sqlite3.connect(path)
+        try:
+            with self._lock:
+                self._conn.backup(conn)
+            with conn:
+                conn.executemany("INSERT INTO chunks (idx, text, meta) VALUES (?, ?, ?)", self._rows(chunks, len(self)))
+        finally:
+            conn.close()
+
+class _QueryBatcher:
+    """Coalesces embed_query calls from concurrent threads (e.g. Streamlit sessions that
+    share one cached store) into a single embeddings request.
+    
+    The first caller waits window() seconds for others to join, embeds the whole batch
+    and hands each caller its own row; callers arriving later start the next batch.
+    """
+    
+    def __init__(self, embed_many, window):
+        self._embed_many = embed_many
+        self._window = window  # called on every flush, so the setting can change at any time
+        self._lock = threading.Lock()
+        self._pending = []  # (query, future) waiting for the current leader
+    
+    def embed(self, query: str) -> np.ndarray:
+        future = Future()
+        with self._lock:
+            self._pending.append((query, future))
+            leader = len(self._pending) == 1
+        
+        if leader:
+            batch = []
+            try:
+                time.sleep(self._window())
+                with self._lock:
+                    batch, self._pending = self._pending, []
+                embeddings = self._embed_many([q for q, _ in batch])
+                for i, (_, waiting) in enumerate(batch):
+                    waiting.set_result(embeddings[i:i + 1])
+            except BaseException as e:
+                # Never leave a follower waiting, even when the leader's thread is being
+                # unwound (e.g. a Streamlit rerun); followers get an ordinary exception
+                # so the interruption does not stop their own scripts
+                if not batch:
+                    with self._lock:
+                        batch, self._pending = self._pending, []
+                error = e if isinstance(e, Exception) else Exception(f"Query embedding was interrupted: {e!r}")
+                for _, waiting in batch:
+                    if not waiting.done():
+                        waiting.set_exception(error)
+                raise
+        
+        return future.result()
+
+INDEX_TYPES = ("auto", "flat", "sq_fp16", "sq8", "hnsw", "ivfpq")
 
 class VectorStore:
-    def __init__(self, provider: str = "openai"):
+    def __init__(self, provider: str = "openai", index_type: str = "auto"):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type: {index_type} (expected one of {', '.join(INDEX_TYPES)})")
+        
         self.provider = provider
         self.index = None
         self.chunks = []
         self.metadata = {}
+        self._index_mmapped = False
+        self._index_on_gpu = False
+        
+        # Embeddings already fetched for identical text are reused from here (None disables)
+        self.embedding_cache_path = "data/vectors/embedding_cache.sqlite3"
+        
+        # FAISS index settings. "auto" scans exhaustively over float16-quantized
+        # vectors (half the memory of "flat", no measurable recall loss; fastest for
+        # small documents) and switches to an HNSW graph for large ones; with faiss-gpu
+        # and a CUDA device, corpora of gpu_min_vectors or more get an exact flat index
+        # searched on the GPU instead. "sq8" stores one byte per dimension.
+        self.index_type = index_type
+        self.hnsw_min_vectors = 10000  # "auto" uses HNSW from this many chunks
+        self.hnsw_m = 32
+        self.hnsw_ef_construction = 200
+        self.hnsw_ef_search = 64
+        self.ivfpq_min_vectors = 10000  # fewer vectors are too few to train the quantizers
+        self.ivfpq_m = 64  # sub-quantizers (bytes per vector)
+        self.ivf_nprobe = 16
+        self.gpu_min_vectors = 50000  # smaller indexes search faster than the copy to the GPU pays off
+        self.query_batch_window = 0.005  # seconds embed_query waits for concurrent queries to batch with
+        self._query_batcher = _QueryBatcher(self.embed_queries, lambda: self.query_batch_window)
         
         if provider == "openai":
             # the newest OpenAI model is "gpt-5" which was released August 7, 2025.
             # do not change this unless explicitly requested by the user
             api_key = os.getenv("OPENAI_API_KEY")
             if api_key:
-                self.openai_client = OpenAI(api_key=api_key)
+                self.openai_client = get_openai_client(api_key)
             else:
                 self.openai_client = None
             self.embedding_model = "text-embedding-ada-002"
             self.dimension = 1536  # Ada-002 embedding dimension
+            self.embedding_batch_size = 64  # Texts per embeddings request
             
         elif provider == "google":
             api_key = os.getenv("GEMINI_API_KEY")
@@ -41,8 +370,9 @@ class VectorStore:
                 self.google_client = None
             self.embedding_model = "models/embedding-001"  # Google's embedding model
             self.dimension = 768  # Google embedding dimension
+            self.embedding_batch_size = 100  # Texts per embed_content request
         
-    def add_document(self, chunks: List[Dict], metadata: Dict):
+    def add_document(self, chunks: List[Dict], metadata: Dict, batch_size: Optional[int] = None):
         """Add document chunks to vector store"""
         try:
             # Check if API client is available
@@ -55,106 +385,395 @@ class VectorStore:
             texts = [chunk['text'] for chunk in chunks]
             
             # Generate embeddings
-            embeddings = self._generate_embeddings(texts)
+            embeddings = self._generate_embeddings(texts, batch_size=batch_size)
             
-            # Create FAISS index
-            self.index = faiss.IndexFlatIP(self.dimension)  # Inner product for cosine similarity
-            
-            # Normalize embeddings for cosine similarity
-            faiss.normalize_L2(embeddings)
+            self._index_document(chunks, metadata, embeddings)
             
-            # Add to index
-            self.index.add(embeddings)
+        except Exception as e:
+            raise Exception(f"Error adding document to vector store: {str(e)}")
+    
+    async def add_document_async(self, chunks: List[Dict], metadata: Dict, batch_size: Optional[int] = None, concurrency: int = 8):
+        """Add document chunks to vector store, requesting embedding batches concurrently"""
+        try:
+            # Check if API client is available
+            if self.provider == "openai" and not self.openai_client:
+                raise Exception("OpenAI API key not configured. Please set your API key.")
+            elif self.provider == "google" and not self.google_client:
+                raise Exception("Google Gemini API key not configured. Please set your API key.")
             
-            # Store chunks and metadata
-            self.chunks = chunks
-            self.metadata = metadata
+            # Extract text from chunks
+            texts = [chunk['text'] for chunk in chunks]
             
-            # Store provider info in metadata
-            self.metadata['provider'] = self.provider
+            # Generate embeddings
+            embeddings = await self._agenerate_embeddings(texts, batch_size=batch_size, concurrency=concurrency)
             
-            # Save to disk
-            self._save_to_disk(metadata['id'])
+            self._index_document(chunks, metadata, embeddings)
             
         except Exception as e:
             raise Exception(f"Error adding document to vector store: {str(e)}")
     
+    def _index_document(self, chunks: List[Dict], metadata: Dict, embeddings: np.ndarray):
+        """Index a document's chunks and persist them. Chunks for the document that is already
+        loaded are appended to its index; any other document gets a fresh index.
+        Embeddings arrive L2-normalized from _generate_embeddings."""
+        appending = (
+            self.index is not None
+            and self.index.d == self.dimension
+            and self.metadata.get('id') == metadata['id']
+        )
+        if appending:
+            # Only the new vectors are added; chunk ids continue after the existing ones
+            offset = len(self.chunks)
+            chunks = [{**chunk, 'chunk_id': offset + i} for i, chunk in enumerate(chunks)]
+            if self._index_mmapped:
+                # A memory-mapped index is read-only; read it into memory again. clone_index
+                # cannot copy the on-disk inverted lists a mapped IVF index uses.
+                self.index = faiss.read_index(f"data/vectors/{metadata['id']}.faiss")
+                self._index_mmapped = False
+            self.index.add(embeddings)
+            # The new chunks reach the chunk store only with the rest of the save
+            appended_chunks = chunks
+            metadata = {**self.metadata, **metadata}
+            if 'total_chunks' in metadata:
+                metadata['total_chunks'] = offset + len(chunks)
+        else:
+            # Create FAISS index and add the embeddings
+            self.index = self._create_index(embeddings)
+            self._index_mmapped = False
+            self._index_on_gpu = False
+            self.index.add(embeddings)
+            if isinstance(self.index, faiss.IndexIVF):
+                # Lets mmr_search reconstruct stored vectors by id
+                self.index.make_direct_map()
+            self.chunks = chunks
+            appended_chunks = []
+        
+        # Store metadata
+        self.metadata = metadata
+        
+        # Store provider info in metadata
+        self.metadata['provider'] = self.provider
+        
+        # Save to disk
+        try:
+            self._save_to_disk(metadata['id'], appended_chunks)
+        except Exception:
+            if appending:
+                # The files on disk are unchanged; reload them so memory matches again
+                try:
+                    self.load_document(metadata['id'])
+                except Exception:
+                    pass
+            raise
+        self._move_index_to_gpu()
+    
+    def _move_index_to_gpu(self):
+        """Serve large indexes from the GPU when faiss-gpu and a CUDA device are available"""
+        if self._index_on_gpu or self.index is None or self.index.ntotal < self.gpu_min_vectors:
+            return
+        if not isinstance(self.index, faiss.IndexFlat):
+            # Only the flat GPU index can reconstruct vectors, which mmr_search needs
+            return
+        resources = _get_gpu_resources()
+        if resources is None:
+            return
+        try:
+            self.index = faiss.index_cpu_to_gpu(resources, 0, self.index)
+        except RuntimeError:
+            return  # keep searching on the CPU
+        self._index_on_gpu = True
+        self._index_mmapped = False
+    
+    def _create_index(self, embeddings: np.ndarray) -> faiss.Index:
+        """Create an empty (trained, if needed) inner-product index suited to the embeddings"""
+        n_vectors = len(embeddings)
+        index_type = self.index_type
+        if index_type == "auto":
+            if n_vectors >= self.gpu_min_vectors and _get_gpu_resources() is not None:
+                index_type = "flat"  # moved to the GPU by _move_index_to_gpu
+            else:
+                index_type = "hnsw" if n_vectors >= self.hnsw_min_vectors else "sq_fp16"
+        if index_type == "ivfpq" and n_vectors < self.ivfpq_min_vectors:
+            index_type = "sq_fp16"
+        
+        if index_type == "hnsw":
+            index = faiss.IndexHNSWFlat(self.dimension, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = self.hnsw_ef_construction
+            return index
+        
+        if index_type == "ivfpq":
+            nlist = max(1, int(math.sqrt(n_vectors)))
+            m = self.ivfpq_m if self.dimension % self.ivfpq_m == 0 else 8
+            quantizer = faiss.IndexFlatIP(self.dimension)
+            index = faiss.IndexIVFPQ(quantizer, self.dimension, nlist, m, 8, faiss.METRIC_INNER_PRODUCT)
+            index.train(embeddings)
+            index.nprobe = self.ivf_nprobe
+            return index
+        
+        if index_type in ("sq_fp16", "sq8"):
+            # Vectors go in as float32 and are quantized on add; queries stay float32
+            qtype = faiss.ScalarQuantizer.QT_fp16 if index_type == "sq_fp16" else faiss.ScalarQuantizer.QT_8bit
+            index = faiss.IndexScalarQuantizer(self.dimension, qtype, faiss.METRIC_INNER_PRODUCT)
+            index.train(embeddings)  # learns the per-dimension value range for sq8
+            return index
+        
+        return faiss.IndexFlatIP(self.dimension)  # Inner product for cosine similarity
+    
+    def _set_search_params(self, k: int):
+        """Widen the approximate index's search so it can return k good candidates"""
+        hnsw = getattr(self.index, "hnsw", None)
+        if hnsw is not None:
+            hnsw.efSearch = max(self.hnsw_ef_search, k)
+        elif hasattr(self.index, "nprobe"):  # CPU or GPU IVF index
+            self.index.nprobe = self.ivf_nprobe
+    
     def load_document(self, document_id: str):
         """Load document from disk"""
         try:
-            # Load index
+            # Load index, memory-mapped so its pages are read on demand
             index_path = f"data/vectors/{document_id}.faiss"
             if os.path.exists(index_path):
-                self.index = faiss.read_index(index_path)
+                try:
+                    self.index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+                    self._index_mmapped = True
+                except RuntimeError:
+                    # Not every index type supports mmap
+                    self.index = faiss.read_index(index_path)
+                    self._index_mmapped = False
+                self._index_on_gpu = False
             
             # Load chunks and metadata
-            data_path = f"data/vectors/{document_id}.pkl"
-            if os.path.exists(data_path):
-                with open(data_path, 'rb') as f:
-                    data = pickle.load(f)
-                    self.chunks = data['chunks']
+            data = None
+            metadata_path = f"data/vectors/{document_id}.json"
+            chunks_path = f"data/vectors/{document_id}.chunks.sqlite3"
+            try:
+                with open(metadata_path, 'rb') as f:
+                    data = {'metadata': load_json_bytes(f.read()), 'chunks': _SqliteChunks(chunks_path)}
+            except FileNotFoundError:
+                # Stores pickled before the SQLite layout: read once, then convert
+                legacy_path = f"data/vectors/{document_id}.pkl"
+                try:
+                    with open(legacy_path, 'rb') as f:
+                        data = _PlainDataUnpickler(f).load()
+                except FileNotFoundError:
+                    pass
+                else:
+                    data['chunks'] = _SqliteChunks.create(chunks_path, data['chunks'])
                     self.metadata = data['metadata']
-                    
-                    # Update provider if stored in metadata
-                    if 'provider' in self.metadata:
-                        self.provider = self.metadata['provider']
-                        # Re-initialize the appropriate client
-                        if self.provider == "openai":
-                            api_key = os.getenv("OPENAI_API_KEY")
-                            if api_key:
-                                self.openai_client = OpenAI(api_key=api_key)
-                        elif self.provider == "google":
-                            api_key = os.getenv("GEMINI_API_KEY")
-                            if api_key and genai:
-                                try:
-                                    genai.configure(api_key=api_key)
-                                    self.google_client = genai
-                                except Exception:
-                                    self.google_client = genai
+                    self._write_metadata(metadata_path)
+                    os.remove(legacy_path)
+            
+            if data is not None:
+                self.chunks = data['chunks']
+                self.metadata = data['metadata']
+                
+                # Update provider if stored in metadata
+                if 'provider' in self.metadata:
+                    self.provider = self.metadata['provider']
+                    # Re-initialize the appropriate client
+                    if self.provider == "openai":
+                        api_key = os.getenv("OPENAI_API_KEY")
+                        if api_key:
+                            self.openai_client = get_openai_client(api_key)
+                    elif self.provider == "google":
+                        api_key = os.getenv("GEMINI_API_KEY")
+                        if api_key and genai:
+                            try:
+                                genai.configure(api_key=api_key)
+                                self.google_client = genai
+                            except Exception:
+                                self.google_client = genai
+            
+            self._move_index_to_gpu()
             
         except Exception as e:
             raise Exception(f"Error loading document from vector store: {str(e)}")
     
-    def search(self, query: str, k: int = 5) -> List[Tuple[Dict, float]]:
-        """Search for relevant chunks"""
+    def embed_query(self, query: str) -> np.ndarray:
+        """Generate the normalized (1, dimension) embedding used to search for a query.
+        Concurrent calls are sent to the provider together as one request."""
+        return self._query_batcher.embed(query)
+    
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        """Generate normalized (len(queries), dimension) query embeddings in one request"""
         try:
-            if self.index is None:
-                return []
-                
             # Check if API client is available
             if self.provider == "openai" and not self.openai_client:
                 raise Exception("OpenAI API key not configured for search.")
             elif self.provider == "google" and not self.google_client:
                 raise Exception("Google Gemini API key not configured for search.")
             
+            return self._generate_embeddings(queries, task_type="retrieval_query")
+            
+        except Exception as e:
+            raise Exception(f"Error embedding query: {str(e)}")
+    
+    def search(self, query: str, k: int = 5, query_embedding: Optional[np.ndarray] = None) -> List[Tuple[Dict, float]]:
+        """Search for relevant chunks (pass query_embedding from embed_query to skip re-embedding)"""
+        try:
+            if self.index is None:
+                return []
+            
             # Generate query embedding
-            query_embedding = self._generate_embeddings([query])
-            faiss.normalize_L2(query_embedding)
+            if query_embedding is None:
+                query_embedding = self.embed_query(query)
             
             # Search
+            self._set_search_params(k)
             scores, indices = self.index.search(query_embedding, k)
             
-            # Return results with chunks and scores
-            results = []
-            for score, idx in zip(scores[0], indices[0]):
-                if idx < len(self.chunks):
-                    results.append((self.chunks[idx], float(score)))
+            # Return results with chunks and scores (-1 marks a missing result)
+            valid = (indices[0] >= 0) & (indices[0] < len(self.chunks))
+            return list(zip(self._chunks_at(indices[0][valid].tolist()), scores[0][valid].tolist()))
             
+        except Exception as e:
+            raise Exception(f"Error searching vector store: {str(e)}")
+    
+    def search_many(self, queries: List[str], k: int = 5,
+                    query_embeddings: Optional[np.ndarray] = None) -> List[List[Tuple[Dict, float]]]:
+        """Search for several queries with one embeddings request and one FAISS search"""
+        try:
+            if self.index is None or not queries:
+                return [[] for _ in queries]
+            
+            if query_embeddings is None:
+                query_embeddings = self.embed_queries(queries)
+            
+            self._set_search_params(k)
+            scores, indices = self.index.search(query_embeddings, k)
+            
+            valid = (indices >= 0) & (indices < len(self.chunks))
+            # Fetch every hit in one lookup, then split the chunks back out per query
+            hits = self._chunks_at(indices[valid].tolist())
+            results, start = [], 0
+            for row_scores, row_valid in zip(scores, valid):
+                count = int(row_valid.sum())
+                results.append(list(zip(hits[start:start + count], row_scores[row_valid].tolist())))
+                start += count
             return results
             
         except Exception as e:
             raise Exception(f"Error searching vector store: {str(e)}")
     
-    def _generate_embeddings(self, texts: List[str]) -> np.ndarray:
-        """Generate embeddings using the selected API provider"""
+    def _chunks_at(self, ids: List[int]) -> List[Dict]:
+        """Look up the chunks for FAISS result ids (one query for a SQLite chunk store)"""
+        if isinstance(self.chunks, _SqliteChunks):
+            return self.chunks.get_many(ids)
+        return [self.chunks[idx] for idx in ids]
+    
+    def mmr_search(self, query: str, k: int = 5, fetch_k: int = 20, lambda_mult: float = 0.7,
+                   query_embedding: Optional[np.ndarray] = None) -> List[Tuple[Dict, float]]:
+        """Search with maximal marginal relevance: take the fetch_k nearest chunks, then pick k
+        that balance relevance (weight lambda_mult) against similarity to chunks already picked.
+        Results are in pick order with their original relevance scores."""
+        try:
+            if self.index is None:
+                return []
+            
+            if query_embedding is None:
+                query_embedding = self.embed_query(query)
+            
+            fetch_k = max(k, fetch_k)
+            self._set_search_params(fetch_k)
+            scores, indices = self.index.search(query_embedding, fetch_k)
+            valid = (indices[0] >= 0) & (indices[0] < len(self.chunks))
+            scores, indices = scores[0][valid], indices[0][valid]
+            if len(indices) <= 1:
+                return list(zip(self._chunks_at(indices.tolist()), scores.tolist()))
+            
+            # Stored vectors are L2-normalized, so dot products are cosine similarities
+            vectors = self.index.reconstruct_batch(indices)
+            similarity = vectors @ vectors.T
+            
+            selected = [0]  # the most relevant chunk always comes first
+            max_similarity = similarity[0].copy()
+            remaining = np.ones(len(indices), dtype=bool)
+            remaining[0] = False
+            while len(selected) < min(k, len(indices)):
+                mmr = lambda_mult * scores - (1 - lambda_mult) * max_similarity
+                mmr[~remaining] = -np.inf
+                pick = int(np.argmax(mmr))
+                selected.append(pick)
+                remaining[pick] = False
+                np.maximum(max_similarity, similarity[pick], out=max_similarity)
+            
+            return list(zip(self._chunks_at(indices[selected].tolist()), scores[selected].tolist()))
+            
+        except Exception as e:
+            raise Exception(f"Error searching vector store: {str(e)}")
+    
+    def _generate_embeddings(self, texts: List[str], batch_size: Optional[int] = None,
+                             task_type: str = "retrieval_document") -> np.ndarray:
+        """Generate L2-normalized embeddings (ready for inner-product search and storage),
+        requesting only texts that are not in the embedding cache"""
+        embeddings, missing, keys = self._lookup_cached_embeddings(texts, task_type)
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            try:
+                fresh = self._request_embeddings(missing_texts, batch_size, task_type)
+            except Exception as e:
+                fresh = self._fallback_embeddings(missing_texts, e)
+            else:
+                self._store_cached_embeddings(keys, missing, fresh)
+            embeddings[missing] = fresh
+        
+        if embeddings.size:
+            # Normalize embeddings for cosine similarity
+            faiss.normalize_L2(embeddings)
+        return embeddings
+    
+    def _lookup_cached_embeddings(self, texts: List[str], task_type: str) -> Tuple[np.ndarray, List[int], List[bytes]]:
+        """Return an embedding matrix with cached rows filled in, the positions still
+        missing, and each text's cache key"""
+        embeddings = np.empty((len(texts), self.dimension), dtype=np.float32)
+        if not self.embedding_cache_path:
+            return embeddings, list(range(len(texts))), []
+        
+        keys = [_EmbeddingCache.key(self.embedding_model, task_type, text) for text in texts]
+        cached = _get_embedding_cache(self.embedding_cache_path).get_many(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            vector = cached.get(key)
+            if vector is not None and len(vector) == self.dimension:
+                embeddings[i] = vector
+            else:
+                missing.append(i)
+        return embeddings, missing, keys
+    
+    def _store_cached_embeddings(self, keys: List[bytes], positions: List[int], embeddings: np.ndarray):
+        """Cache freshly requested embeddings (keys is empty when the cache is disabled)"""
+        if self.embedding_cache_path and keys:
+            _get_embedding_cache(self.embedding_cache_path).put_many([keys[i] for i in positions], embeddings)
+    
+    def _fallback_embeddings(self, texts: List[str], error: Exception) -> np.ndarray:
+        """Hash-based stand-in embeddings when the Gemini API fails (never cached);
+        re-raises error for other providers or a missing client"""
+        if not (self.provider == "google" and self.google_client):
+            raise error
+        
+        # Fallback to a basic hash-based embedding for demo purposes
+        st.warning("Google embedding API not available, using fallback method")
+        embeddings = np.empty((len(texts), self.dimension), dtype=np.float32)
+        for i, text in enumerate(texts):
+            # Simple hash-based embedding (for demo only): the text's hash seeds
+            # a generator that fills its row in place, reproducibly
+            seed = int.from_bytes(hashlib.md5(text.encode()).digest()[:8], 'little')
+            np.random.default_rng(seed).random(dtype=np.float32, out=embeddings[i])
+        return embeddings
+    
+    def _request_embeddings(self, texts: List[str], batch_size: Optional[int] = None,
+                            task_type: str = "retrieval_document") -> np.ndarray:
+        """Request embeddings from the selected API provider (task_type applies to Gemini:
+        "retrieval_document" for chunks, "retrieval_query" for search queries)"""
+        batch_size = batch_size or self.embedding_batch_size
         try:
             if self.provider == "openai":
                 if not self.openai_client:
                     raise Exception("OpenAI API key not configured")
                 
-                # Split into batches to handle API limits
-                batch_size = 100
-                all_embeddings = []
+                # Split into batches to handle API limits; each batch is written
+                # straight into its rows of the preallocated matrix
+                all_embeddings = np.empty((len(texts), self.dimension), dtype=np.float32)
                 
                 for i in range(0, len(texts), batch_size):
                     batch = texts[i:i + batch_size]
@@ -164,43 +783,29 @@ class VectorStore:
                         input=batch
                     )
                     
-                    batch_embeddings = [item.embedding for item in response.data]
-                    all_embeddings.extend(batch_embeddings)
+                    all_embeddings[i:i + len(batch)] = [item.embedding for item in response.data]
                 
-                return np.array(all_embeddings, dtype=np.float32)
+                return all_embeddings
                 
             elif self.provider == "google":
                 if not self.google_client:
                     raise Exception("Google Gemini API key not configured")
                 
                 # Google Gemini embedding generation
-                all_embeddings = []
+                all_embeddings = np.empty((len(texts), self.dimension), dtype=np.float32)
                 
-                try:
-                    for text in texts:
-                        # Use Google's embedding API
-                        result = genai.embed_content(
-                            model=self.embedding_model,
-                            content=text
-                        )
-                        embedding = np.array(result['embedding'], dtype=np.float32)
-                        all_embeddings.append(embedding)
-                    
-                    return np.array(all_embeddings, dtype=np.float32)
-                
-                except Exception as e:
-                    # Fallback to a basic hash-based embedding for demo purposes
-                    st.warning("Google embedding API not available, using fallback method")
-                    all_embeddings = []
-                    for text in texts:
-                        # Simple hash-based embedding (for demo only)
-                        import hashlib
-                        hash_obj = hashlib.md5(text.encode())
-                        hash_int = int(hash_obj.hexdigest(), 16)
-                        np.random.seed(hash_int % 1000000)  # Use hash as seed for reproducibility
-                        embedding = np.random.rand(self.dimension).astype(np.float32)
-                        all_embeddings.append(embedding)
+                for i in range(0, len(texts), batch_size):
+                    batch = texts[i:i + batch_size]
                     
+                    # Use Google's embedding API (one request per batch)
+                    result = genai.embed_content(
+                        model=self.embedding_model,
+                        content=batch,
+                        task_type=task_type
+                    )
+                    all_embeddings[i:i + len(batch)] = result['embedding']
+                
+                return all_embeddings
                     
         except Exception as e:
             raise Exception(f"Error generating embeddings with {self.provider}: {str(e)}")
@@ -208,24 +813,128 @@ class VectorStore:
         # This should never be reached, but satisfies type checker
         return np.array([], dtype=np.float32)
     
-    def _save_to_disk(self, document_id: str):
-        """Save vector store to disk"""
+    async def _agenerate_embeddings(self, texts: List[str], batch_size: Optional[int] = None, concurrency: int = 8) -> np.ndarray:
+        """Async variant of _generate_embeddings"""
+        embeddings, missing, keys = self._lookup_cached_embeddings(texts, "retrieval_document")
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            try:
+                fresh = await self._arequest_embeddings(missing_texts, batch_size, concurrency)
+            except Exception as e:
+                fresh = self._fallback_embeddings(missing_texts, e)
+            else:
+                self._store_cached_embeddings(keys, missing, fresh)
+            embeddings[missing] = fresh
+        
+        if embeddings.size:
+            faiss.normalize_L2(embeddings)
+        return embeddings
+    
+    async def _arequest_embeddings(self, texts: List[str], batch_size: Optional[int] = None, concurrency: int = 8) -> np.ndarray:
+        """Request embeddings with up to `concurrency` batch requests in flight"""
+        batch_size = batch_size or self.embedding_batch_size
+        batches = [(i, texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)]
+        all_embeddings = np.empty((len(texts), self.dimension), dtype=np.float32)
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        try:
+            if self.provider == "openai":
+                if not self.openai_client:
+                    raise Exception("OpenAI API key not configured")
+                
+                # Retries are handled by _with_retry_backoff so rate-limit headers can be honoured
+                client = make_async_openai_client(self.openai_client.api_key, max_retries=0)
+                
+                async def embed_batch(start, batch):
+                    async with semaphore:
+                        response = await _with_retry_backoff(
+                            lambda: client.embeddings.create(model=self.embedding_model, input=batch)
+                        )
+                        all_embeddings[start:start + len(batch)] = [item.embedding for item in response.data]
+                
+                try:
+                    await asyncio.gather(*(embed_batch(start, batch) for start, batch in batches))
+                finally:
+                    await client.close()
+                
+                return all_embeddings
+            
+            elif self.provider == "google":
+                if not self.google_client:
+                    raise Exception("Google Gemini API key not configured")
+                
+                if not hasattr(genai, "embed_content_async"):
+                    # Older SDKs have no async API; keep the synchronous path and its fallback
+                    return await asyncio.to_thread(self._request_embeddings, texts, batch_size)
+                
+                async def embed_batch(start, batch):
+                    async with semaphore:
+                        result = await _with_retry_backoff(
+                            lambda: genai.embed_content_async(
+                                model=self.embedding_model, content=batch, task_type="retrieval_document"
+                            )
+                        )
+                        all_embeddings[start:start + len(batch)] = result['embedding']
+                
+                await asyncio.gather(*(embed_batch(start, batch) for start, batch in batches))
+                return all_embeddings
+            
+        except Exception as e:
+            raise Exception(f"Error generating embeddings with {self.provider}: {str(e)}")
+        
+        return np.array([], dtype=np.float32)
+    
+    def _save_to_disk(self, document_id: str, appended_chunks: Optional[List[Dict]] = None):
+        """Save vector store to disk, with appended_chunks added after the current chunks.
+        The index, chunks and metadata are written in parallel to temporary files and only
+        renamed into place once every write has succeeded."""
+        writes = {}  # final path -> function writing that file to the path it is given
         try:
             # Ensure directory exists
-            os.makedirs("data/vectors", exist_ok=True)
+            ensure_dir("data/vectors")
             
-            # Save FAISS index
+            # FAISS index (GPU indexes are copied back to the CPU to serialize)
             if self.index is not None:
-                faiss.write_index(self.index, f"data/vectors/{document_id}.faiss")
+                index = faiss.index_gpu_to_cpu(self.index) if self._index_on_gpu else self.index
+                writes[f"data/vectors/{document_id}.faiss"] = lambda path: faiss.write_index(index, path)
+            
+            # Chunks: a new SQLite store, or a copy of this document's store with the
+            # appended rows, swapped in together with the index and metadata
+            appended_chunks = appended_chunks or []
+            chunks_path = f"data/vectors/{document_id}.chunks.sqlite3"
+            if not (isinstance(self.chunks, _SqliteChunks) and self.chunks.path == chunks_path):
+                chunks = list(self.chunks) + appended_chunks
+                writes[chunks_path] = lambda path: _SqliteChunks.write(path, chunks)
+            elif appended_chunks:
+                store = self.chunks
+                writes[chunks_path] = lambda path: store.write_extended(path, appended_chunks)
+            new_chunk_store = chunks_path in writes
+            
+            # Metadata last: load_document treats it as the marker of a complete store
+            writes[f"data/vectors/{document_id}.json"] = self._write_metadata
             
-            # Save chunks and metadata
-            data = {
-                'chunks': self.chunks,
-                'metadata': self.metadata
-            }
+            # faiss and sqlite3 release the GIL while writing, so the files are written concurrently
+            with ThreadPoolExecutor(max_workers=len(writes)) as executor:
+                futures = [executor.submit(write, f"{path}.tmp") for path, write in writes.items()]
+            for future in futures:
+                future.result()
             
-            with open(f"data/vectors/{document_id}.pkl", 'wb') as f:
-                pickle.dump(data, f)
+            for path in writes:
+                os.replace(f"{path}.tmp", path)
+            writes = {}
+            
+            if new_chunk_store:
+                self.chunks = _SqliteChunks(chunks_path)
                 
         except Exception as e:
             raise Exception(f"Error saving vector store: {str(e)}")
+        finally:
+            # Nothing was replaced if a write failed; drop its temporary files
+            for path in writes:
+                if os.path.exists(f"{path}.tmp"):
+                    os.remove(f"{path}.tmp")
+    
+    def _write_metadata(self, path: str):
+        """Write document metadata as JSON"""
+        with open(path, 'wb') as f:
+            f.write(dump_json_bytes(self.metadata))